@@ -1,14 +1,34 @@
 import asyncio
+import json
 import logging
 import re
 from aiogram import Bot, Dispatcher, types
 from aiogram.filters import CommandStart, Command
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.methods import DeleteWebhook
 from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
-import requests
+import aiohttp
 
 TOKEN = ''
 
+API_URL = "https://api.intelligence.io.solutions/api/v1/chat/completions"
+API_KEY = ""
+
+# Общий пул соединений к API моделей: сколько соединений держим, сколько живёт простаивающее,
+# сколько запросов к моделям идёт одновременно (остальные ждут своей очереди) и таймауты
+MAX_CONNECTIONS = 100
+KEEPALIVE_TIMEOUT = 60
+MAX_CONCURRENT_COMPLETIONS = 32
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=300, connect=10, sock_read=180)
+# Потоковый ответ может идти сколько угодно долго, пока приходят токены: общего лимита нет,
+# ограничена только пауза между кусками
+STREAM_TIMEOUT = aiohttp.ClientTimeout(total=None, connect=10, sock_read=180)
+
+# Ответ приходит потоком: правим сообщение не чаще раза в EDIT_INTERVAL секунд,
+# длиннее MAX_MESSAGE_LENGTH символов — продолжаем в новом сообщении
+EDIT_INTERVAL = 1.5
+MAX_MESSAGE_LENGTH = 4000
+
 logging.basicConfig(level=logging.INFO)
 bot = Bot(TOKEN)
 dp = Dispatcher()
@@ -16,6 +36,10 @@ dp = Dispatcher()
 # Словарь для хранения выбранной пользователем модели
 user_models = {}
 
+# Одна сессия на всё приложение (создаётся при первом запросе, закрывается при остановке)
+http_session = None
+completion_slots = asyncio.Semaphore(MAX_CONCURRENT_COMPLETIONS)
+
 # Полный словарь моделей (для кнопки "О моделях" и полного списка)
 models = {
     "Qwen-32B": "Qwen/QwQ-32B",  # программирование
@@ -111,6 +135,142 @@ def get_start_keyboard():
     ])
     return keyboard
 
+def get_http_session():
+    """
+    Возвращает общую aiohttp-сессию с пулом keep-alive соединений.
+    """
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS, keepalive_timeout=KEEPALIVE_TIMEOUT, ttl_dns_cache=300)
+        http_session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=REQUEST_TIMEOUT,
+            headers={
+                "Content-Type": "application/json",
+                "Authorization": API_KEY
+            }
+        )
+    return http_session
+
+async def close_http_session():
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+
+async def stream_completion(model, text):
+    """
+    Запрашивает ответ модели потоком (SSE) и отдаёт куски текста по мере генерации,
+    не блокируя event loop. Одновременно идёт не больше MAX_CONCURRENT_COMPLETIONS запросов.
+    """
+    data = {
+        "model": model,
+        "messages": [
+            {
+                "role": "system",
+                "content": "You are the best assistant and you answer perfectly in Russian."
+            },
+            {
+                "role": "user",
+                "content": text
+            }
+        ],
+        "stream": True,
+    }
+    async with completion_slots:
+        async with get_http_session().post(API_URL, json=data, timeout=STREAM_TIMEOUT) as response:
+            response.raise_for_status()
+            # Если API не умеет в поток, он вернёт обычный JSON целиком
+            if response.content_type == "application/json":
+                data_response = await response.json()
+                yield data_response['choices'][0]['message']['content']
+                return
+            async for line in response.content:
+                line = line.decode("utf-8").strip()
+                if not line.startswith("data:"):
+                    continue
+                payload = line[len("data:"):].strip()
+                if payload == "[DONE]":
+                    break
+                choices = json.loads(payload).get('choices') or []
+                content = choices[0].get('delta', {}).get('content') if choices else None
+                if content:
+                    yield content
+
+def clean_reply(text):
+    """
+    Убирает размышления модели: если есть </think>, берём только текст после последнего вхождения,
+    незакрытый <think> значит, что модель ещё думает, и его показывать рано.
+    """
+    lower_text = text.lower()
+    if "</think>" in lower_text:
+        idx = lower_text.rfind("</think>")
+        text = text[idx + len("</think>"):]
+    elif "<think>" in lower_text:
+        text = text[:lower_text.find("<think>")]
+    # Удаляем все оставшиеся теги <think> и </think> и лишние пробелы
+    return re.sub(r'</?think>\n?', '', text, flags=re.IGNORECASE).strip()
+
+class StreamingReply:
+    """
+    Ответ, который дописывается по мере генерации.
+    Первое сообщение — «Ваш запрос обрабатывается...», дальше оно правится не чаще EDIT_INTERVAL,
+    а каждые MAX_MESSAGE_LENGTH символов начинается новое сообщение.
+    Пока ответ идёт — простой текст (Markdown может быть недописан), в конце — Markdown.
+    """
+
+    def __init__(self, first_message):
+        self.messages = [first_message]
+        self.shown = [first_message.text]
+        self.next_edit_at = 0.0
+
+    def due(self):
+        return asyncio.get_running_loop().time() >= self.next_edit_at
+
+    async def update(self, text, final=False):
+        chunks = [text[i:i + MAX_MESSAGE_LENGTH] for i in range(0, len(text), MAX_MESSAGE_LENGTH)]
+        try:
+            for index, chunk in enumerate(chunks):
+                if index == len(self.messages):
+                    self.messages.append(await self._send(chunk, final))
+                    self.shown.append(chunk)
+                elif final or self.shown[index] != chunk:
+                    await self._edit(index, chunk, final)
+        except TelegramRetryAfter as e:
+            if final:
+                await asyncio.sleep(e.retry_after)
+                await self.update(text, final=True)
+                return
+            # Telegram просит подождать — пропускаем правки, текст догонит следующая
+            self.next_edit_at = asyncio.get_running_loop().time() + e.retry_after
+            return
+        self.next_edit_at = asyncio.get_running_loop().time() + EDIT_INTERVAL
+
+    async def _send(self, chunk, final):
+        if final:
+            try:
+                return await self.messages[0].answer(chunk, parse_mode="Markdown")
+            except TelegramBadRequest:
+                pass
+        return await self.messages[0].answer(chunk)
+
+    async def _edit(self, index, chunk, final):
+        message = self.messages[index]
+        if final:
+            try:
+                await message.edit_text(chunk, parse_mode="Markdown")
+                self.shown[index] = chunk
+                return
+            except TelegramBadRequest as e:
+                # Недопустимая разметка — оставляем простой текст
+                logging.info(f"Markdown не подошёл: {e}")
+        if self.shown[index] == chunk:
+            return
+        try:
+            await message.edit_text(chunk)
+        except TelegramBadRequest as e:
+            if "not modified" not in str(e):
+                raise
+        self.shown[index] = chunk
+
 # Команда /start с красивым приветствием
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message):
@@ -159,55 +319,36 @@ async def handle_callback(callback: types.CallbackQuery):
 # Обработчик сообщений пользователя
 @dp.message()
 async def filter_messages(message: Message):
-    await message.answer("Ваш запрос обрабатывается, пожалуйста, подождите...")
+    status_message = await message.answer("Ваш запрос обрабатывается, пожалуйста, подождите...")
     model_used = user_models.get(message.from_user.id, "mistralai/Ministral-8B-Instruct-2410")
-    
-    url = "https://api.intelligence.io.solutions/api/v1/chat/completions"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": ("")
-    }
-    data = {
-        "model": model_used,
-        "messages": [
-            {
-                "role": "system",
-                "content": "You are the best assistant and you answer perfectly in Russian."
-            },
-            {
-                "role": "user",
-                "content": message.text
-            }
-        ],
-    }
 
-    response = requests.post(url, headers=headers, json=data)
+    reply = StreamingReply(status_message)
+    parts = []
     try:
-        data_response = response.json()
+        async for piece in stream_completion(model_used, message.text):
+            parts.append(piece)
+            # Текст собираем и чистим только когда пора править сообщение
+            if reply.due():
+                visible_text = clean_reply("".join(parts))
+                if visible_text:
+                    await reply.update(visible_text)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logging.error(f"Ошибка запроса к API: {e!r}")
+        await message.answer("Извините, произошла ошибка при обработке запроса. Попробуйте повторить позже.")
+        return
     except Exception as e:
-        logging.error(f"Ошибка декодирования JSON: {e}")
+        logging.error(f"Ошибка разбора ответа API: {e}")
         await message.answer("Извините, произошла ошибка при обработке запроса. Попробуйте повторить позже.")
         return
 
-    bot_text = data_response['choices'][0]['message']['content']
-    
-    # Если в ответе присутствует тег </think>, берём только текст после последнего вхождения
-    lower_text = bot_text.lower()
-    if "</think>" in lower_text:
-        idx = lower_text.rfind("</think>")
-        bot_text = bot_text[idx + len("</think>"):]
-    # Удаляем все оставшиеся теги <think> и </think> и лишние пробелы
-    bot_text = re.sub(r'</?think>\n?', '', bot_text, flags=re.IGNORECASE).strip()
-    
-    # Разбиваем текст на части, если он превышает 4000 символов
-    max_length = 4000
-    if len(bot_text) > max_length:
-        for i in range(0, len(bot_text), max_length):
-            await message.answer(bot_text[i:i+max_length], parse_mode="Markdown")
-    else:
-        await message.answer(bot_text, parse_mode="Markdown")
+    bot_text = clean_reply("".join(parts))
+    if not bot_text:
+        await message.answer("Извините, модель не вернула ответа. Попробуйте повторить позже.")
+        return
+    await reply.update(bot_text, final=True)
 
 async def main():
+    dp.shutdown.register(close_http_session)
     await bot(DeleteWebhook(drop_pending_updates=True))
     await dp.start_polling(bot)
 
@@ -0,0 +1,183 @@
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from yt_dlp.utils import DownloadCancelled
+
+from metrics import DOWNLOADED_BYTES, STAGE_SECONDS
+
+AUDIO_EXTENSIONS = ('.m4a', '.opus', '.ogg', '.mp3')
+MEDIA_EXTENSIONS = ('.mp4', '.mov', '.jpg', '.jpeg', '.png') + AUDIO_EXTENSIONS
+
+# Поля из хука yt-dlp, которые нужны для сообщения о прогрессе
+PROGRESS_FIELDS = ('status', 'downloaded_bytes', 'total_bytes', 'total_bytes_estimate', 'speed', 'eta')
+
+
+class EngineBusy(Exception):
+    """
+    Очередь движка заполнена — новую задачу сейчас не принять.
+    """
+
+
+class DownloadJob:
+    """
+    Одна задача скачивания: свой прогресс, своя временная папка и своя отмена.
+    """
+
+    def __init__(self, job_id, chat_id, message_id, work_dir):
+        self.job_id = job_id
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.work_dir = work_dir
+        self.title = ''  # название скачанного, заполняет функция скачивания
+        self.progress = {}
+        self._file_progress = {}
+        self._file_bytes = {}
+        self.fragmented = False
+        self.created_at = time.monotonic()
+        self.started = threading.Event()
+        self.finished = threading.Event()
+        self.cancel_event = threading.Event()
+        self._lock = threading.Lock()
+
+    def progress_hook(self, d):
+        """
+        Хук для yt-dlp: сохраняет прогресс этой задачи и прерывает скачивание при отмене.
+        Файлы, которые качаются параллельно (карусели), учитываются по отдельности.
+        """
+        if self.cancel_event.is_set():
+            raise DownloadCancelled(f"Задача {self.job_id} отменена")
+        if d.get('status') in ('downloading', 'finished'):
+            self._count_bytes(d.get('filename'), d.get('downloaded_bytes') or 0)
+        if d.get('fragment_count'):
+            self.fragmented = True
+        if d.get('status') == 'downloading':
+            with self._lock:
+                self._file_progress[d.get('filename')] = {k: d.get(k) for k in PROGRESS_FIELDS}
+                self.progress = self._aggregate()
+
+    def _count_bytes(self, filename, downloaded):
+        # yt-dlp присылает накопленный итог по файлу, в метрику идёт только прирост
+        with self._lock:
+            delta = downloaded - self._file_bytes.get(filename, 0)
+            self._file_bytes[filename] = max(downloaded, self._file_bytes.get(filename, 0))
+        if delta > 0:
+            DOWNLOADED_BYTES.inc(delta)
+
+    def _aggregate(self):
+        files = list(self._file_progress.values())
+        if len(files) == 1:
+            return dict(files[0])
+        return {
+            'status': 'downloading',
+            'downloaded_bytes': sum(f.get('downloaded_bytes') or 0 for f in files),
+            'total_bytes': sum(f.get('total_bytes') or f.get('total_bytes_estimate') or 0 for f in files),
+            'speed': sum(f.get('speed') or 0 for f in files),
+            'eta': max((f.get('eta') or 0 for f in files), default=0),
+        }
+
+    def downloaded_bytes(self):
+        with self._lock:
+            return sum(self._file_bytes.values())
+
+    def get_progress(self):
+        with self._lock:
+            return dict(self.progress)
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def media_files(self):
+        """
+        Возвращает скачанные медиафайлы из папки задачи.
+        """
+        if not os.path.isdir(self.work_dir):
+            return []
+        return sorted(
+            os.path.join(self.work_dir, f)
+            for f in os.listdir(self.work_dir)
+            if f.lower().endswith(MEDIA_EXTENSIONS)
+        )
+
+    def cleanup(self):
+        """
+        Удаляет папку задачи целиком.
+        """
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+class DownloadEngine:
+    """
+    Пул воркеров ограниченного размера для параллельных скачиваний.
+    Кроме работающих, в очереди может ждать не больше max_queued задач.
+    """
+
+    def __init__(self, base_dir, max_workers=4, max_queued=16):
+        self.base_dir = base_dir
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ibratsave-dl")
+        self._slots = threading.BoundedSemaphore(max_workers + max_queued)
+        self.jobs = {}
+        self._lock = threading.Lock()
+
+    def create_job(self, chat_id, message_id):
+        job_id = str(uuid.uuid4())[:8]
+        work_dir = os.path.join(self.base_dir, f"job-{job_id}")
+        os.makedirs(work_dir, exist_ok=True)
+        job = DownloadJob(job_id, chat_id, message_id, work_dir)
+        with self._lock:
+            self.jobs[job_id] = job
+        return job
+
+    def get_job(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def submit(self, job, fn, *args, **kwargs):
+        """
+        Запускает fn(job, *args) в пуле. job.finished выставляется в любом случае.
+        Если очередь заполнена, бросает EngineBusy.
+        """
+        if not self._slots.acquire(blocking=False):
+            raise EngineBusy("Очередь скачиваний заполнена")
+
+        def run():
+            STAGE_SECONDS.observe(time.monotonic() - job.created_at, stage='queue')
+            job.started.set()
+            try:
+                return fn(job, *args, **kwargs)
+            finally:
+                job.finished.set()
+                self._slots.release()
+        return self.executor.submit(run)
+
+    def cancel(self, job_id):
+        job = self.get_job(job_id)
+        if job is None:
+            return False
+        job.cancel()
+        return True
+
+    def release(self, job, cleanup=True):
+        """
+        Убирает задачу из движка. С cleanup=False папка остаётся на диске
+        (её забирает хранилище скачанных файлов).
+        """
+        with self._lock:
+            self.jobs.pop(job.job_id, None)
+        if cleanup:
+            job.cleanup()
+
+    def running_count(self):
+        """
+        Сколько задач качается прямо сейчас: начаты и не закончены.
+        Задачи, ждущие в очереди планировщика или пула, не считаются.
+        """
+        with self._lock:
+            return sum(1 for job in self.jobs.values() if job.started.is_set() and not job.finished.is_set())
@@ -0,0 +1,199 @@
+import os
+import shutil
+import logging
+import threading
+import time
+
+
+def dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+    return total
+
+
+class DownloadStore:
+    """
+    Управляемое хранилище скачанных папок задач с квотой по байтам.
+
+    Каждая папка — запись с размером, временем последнего обращения и набором
+    «закрепов» (pins). Закреплённые папки (идущие задачи, файлы, которые ждёт админ)
+    не удаляются. Остальные вытесняются по LRU, когда суммарный размер превышает квоту.
+    Папки можно найти по ключу, чтобы отдать повторный запрос прямо с диска.
+    """
+
+    def __init__(self, root, quota_bytes, janitor_interval=60, orphan_grace=600):
+        self.root = root
+        self.quota_bytes = quota_bytes
+        self.janitor_interval = janitor_interval
+        self.orphan_grace = orphan_grace
+        self._entries = {}
+        self._by_key = {}
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _entry(self, path):
+        entry = self._entries.get(path)
+        if entry is None:
+            entry = {'size': 0, 'last_access': time.time(), 'pins': set(), 'key': None, 'title': ''}
+            self._entries[path] = entry
+        return entry
+
+    def pin(self, path, reason):
+        with self._lock:
+            self._entry(path)['pins'].add(reason)
+
+    def unpin(self, path, reason):
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None:
+                entry['pins'].discard(reason)
+
+    def pins(self, path):
+        with self._lock:
+            entry = self._entries.get(path)
+            return set(entry['pins']) if entry else set()
+
+    def is_pinned(self, path):
+        with self._lock:
+            entry = self._entries.get(path)
+            return bool(entry and entry['pins'])
+
+    def adopt(self, path, key=None, title=''):
+        """
+        Берёт готовую папку под управление хранилища и, если задан key, запоминает её для повторных запросов.
+        """
+        with self._lock:
+            entry = self._entry(path)
+            entry['size'] = dir_size(path)
+            entry['last_access'] = time.time()
+            entry['title'] = title
+            if key is not None:
+                old_path = self._by_key.get(key)
+                if old_path and old_path != path:
+                    self._drop_key(old_path)
+                entry['key'] = key
+                self._by_key[key] = path
+        self.enforce_quota()
+
+    def lookup(self, key):
+        """
+        Возвращает (путь к папке с готовыми файлами, title) по ключу или None.
+        """
+        with self._lock:
+            path = self._by_key.get(key)
+            if path is None:
+                return None
+            if not os.path.isdir(path) or not os.listdir(path):
+                self._forget(path)
+                return None
+            entry = self._entries[path]
+            entry['last_access'] = time.time()
+            return path, entry['title']
+
+    def refresh(self, path):
+        """
+        Пересчитывает размер папки после того, как из неё что-то удалили.
+        """
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None:
+                return
+            if not os.path.isdir(path) or not os.listdir(path):
+                self.discard(path)
+                return
+            entry['size'] = dir_size(path)
+
+    def discard(self, path):
+        """
+        Удаляет папку с диска и из учёта, даже если она закреплена.
+        """
+        with self._lock:
+            self._forget(path)
+        shutil.rmtree(path, ignore_errors=True)
+
+    def total_size(self):
+        with self._lock:
+            return sum(entry['size'] for entry in self._entries.values())
+
+    def enforce_quota(self):
+        """
+        Вытесняет незакреплённые папки по LRU, пока не уложимся в квоту.
+        """
+        victims = []
+        with self._lock:
+            total = self.total_size()
+            for path, entry in sorted(self._entries.items(), key=lambda item: item[1]['last_access']):
+                if total <= self.quota_bytes:
+                    break
+                if entry['pins']:
+                    continue
+                total -= entry['size']
+                victims.append(path)
+                self._forget(path)
+        for path in victims:
+            logging.info(f"Хранилище: вытесняем {path}")
+            shutil.rmtree(path, ignore_errors=True)
+
+    def sweep(self):
+        """
+        Один проход уборщика: обновляет размеры закреплённых папок, удаляет
+        брошенные папки, о которых хранилище не знает, и применяет квоту.
+        """
+        now = time.time()
+        with self._lock:
+            for path, entry in list(self._entries.items()):
+                if not os.path.isdir(path):
+                    self._forget(path)
+                elif entry['pins']:
+                    entry['size'] = dir_size(path)
+            known = set(self._entries)
+
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if path in known:
+                continue
+            try:
+                if now - os.path.getmtime(path) < self.orphan_grace:
+                    continue
+                logging.info(f"Хранилище: удаляем брошенный {path}")
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.remove(path)
+            except OSError as e:
+                logging.error(f"Ошибка при удалении файла {path}: {e}")
+
+        self.enforce_quota()
+
+    def start_janitor(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._janitor, name="ibratsave-janitor", daemon=True)
+        self._thread.start()
+
+    def stop_janitor(self):
+        self._stop.set()
+
+    def _janitor(self):
+        while not self._stop.wait(self.janitor_interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                logging.error(f"Ошибка уборщика хранилища: {e}")
+
+    def _drop_key(self, path):
+        entry = self._entries.get(path)
+        if entry is not None and entry['key'] is not None:
+            if self._by_key.get(entry['key']) == path:
+                del self._by_key[entry['key']]
+            entry['key'] = None
+
+    def _forget(self, path):
+        self._drop_key(path)
+        self._entries.pop(path, None)
@@ -0,0 +1,205 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+from yt_dlp.utils import DownloadCancelled
+
+from download_engine import EngineBusy
+
+
+class RateLimited(EngineBusy):
+    """
+    У пользователя кончились токены — новую задачу можно будет поставить через retry_in секунд.
+    """
+
+    def __init__(self, retry_in):
+        super().__init__(f"Лимит запросов, повторить через {retry_in:.0f} сек")
+        self.retry_in = retry_in
+
+
+class TokenBucket:
+    def __init__(self, capacity, refill_seconds):
+        self.capacity = capacity
+        self.refill_seconds = refill_seconds
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) / self.refill_seconds)
+        self.updated_at = now
+
+    def take(self):
+        """
+        Забирает токен. Возвращает 0, если получилось, иначе сколько секунд ждать до следующего.
+        """
+        now = time.monotonic()
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) * self.refill_seconds
+
+    def refund(self):
+        """
+        Возвращает токен задачи, которая так и не запустилась.
+        """
+        self._refill(time.monotonic())
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    def is_full(self):
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+
+class FairScheduler:
+    """
+    Очередь перед DownloadEngine: справедливая раздача воркеров между пользователями.
+
+    - У каждого пользователя свой token bucket: burst задач сразу, дальше по одной в refill_seconds.
+    - Задачи админов идут вне общей очереди (приоритетная полоса).
+    - Остальные раздаются по кругу: по одной задаче от каждого пользователя с ожидающими задачами.
+    В движок одновременно отдаётся не больше capacity задач, остальные ждут здесь.
+    """
+
+    def __init__(self, engine, capacity, max_queued=64, burst=5, refill_seconds=20):
+        self.engine = engine
+        self.capacity = capacity
+        self.max_queued = max_queued
+        self.burst = burst
+        self.refill_seconds = refill_seconds
+        self._lock = threading.Lock()
+        self._priority = deque()
+        self._queues = OrderedDict()
+        self._buckets = {}
+        self._running = 0
+
+    def submit(self, user_id, job, fn, *args, priority=False):
+        """
+        Ставит задачу в очередь. Возвращает concurrent.futures.Future с результатом fn(job, *args).
+        Бросает RateLimited, если у пользователя нет токенов, и EngineBusy, если очередь заполнена.
+        """
+        future = Future()
+        with self._lock:
+            if self._queued_count() >= self.max_queued:
+                raise EngineBusy("Очередь планировщика заполнена")
+            if not priority:
+                bucket = self._buckets.setdefault(user_id, TokenBucket(self.burst, self.refill_seconds))
+                retry_in = bucket.take()
+                if retry_in:
+                    raise RateLimited(retry_in)
+            item = (user_id, job, fn, args, future, priority)
+            if priority:
+                self._priority.append(item)
+            else:
+                self._queues.setdefault(user_id, deque()).append(item)
+            self._cleanup_buckets()
+        self._dispatch()
+        return future
+
+    def cancel(self, job):
+        """
+        Убирает ещё не запущенную задачу из очереди. Возвращает True, если она там была.
+        """
+        with self._lock:
+            item = self._remove(job)
+        if item is None:
+            return False
+        job.finished.set()
+        item[4].set_exception(DownloadCancelled(f"Задача {job.job_id} отменена"))
+        return True
+
+    def queued_count(self):
+        with self._lock:
+            return self._queued_count()
+
+    def _queued_count(self):
+        return len(self._priority) + sum(len(q) for q in self._queues.values())
+
+    def position(self, job):
+        """
+        Сколько задач будет запущено раньше этой (0 — следующая). None, если задачи нет в очереди.
+        """
+        with self._lock:
+            for index, item in enumerate(self._priority):
+                if item[1] is job:
+                    return index
+            users = list(self._queues)
+            for user_index, user_id in enumerate(users):
+                queue = self._queues[user_id]
+                for k, item in enumerate(queue):
+                    if item[1] is not job:
+                        continue
+                    ahead = len(self._priority) + k
+                    for other_index, other_id in enumerate(users):
+                        if other_id == user_id:
+                            continue
+                        # Пользователи раньше по кругу успеют отдать k+1 задач, позже — k
+                        rounds = k + 1 if other_index < user_index else k
+                        ahead += min(len(self._queues[other_id]), rounds)
+                    return ahead
+        return None
+
+    def _next_item(self):
+        if self._priority:
+            return self._priority.popleft()
+        if not self._queues:
+            return None
+        user_id, queue = next(iter(self._queues.items()))
+        item = queue.popleft()
+        # Пользователь уходит в конец круга
+        self._queues.move_to_end(user_id)
+        self._drop_empty()
+        return item
+
+    def _remove(self, job):
+        for queue in [self._priority] + list(self._queues.values()):
+            for item in queue:
+                if item[1] is job:
+                    queue.remove(item)
+                    self._drop_empty()
+                    return item
+        return None
+
+    def _drop_empty(self):
+        for user_id in [u for u, q in self._queues.items() if not q]:
+            del self._queues[user_id]
+
+    def _cleanup_buckets(self):
+        # Полные ведра ничем не отличаются от новых — не храним их
+        if len(self._buckets) > 1024:
+            for user_id in [u for u, b in self._buckets.items() if b.is_full() and u not in self._queues]:
+                del self._buckets[user_id]
+
+    def _dispatch(self):
+        while True:
+            with self._lock:
+                if self._running >= self.capacity:
+                    return
+                item = self._next_item()
+                if item is None:
+                    return
+                self._running += 1
+            user_id, job, fn, args, future, priority = item
+            try:
+                engine_future = self.engine.submit(job, fn, *args)
+            except Exception as e:
+                with self._lock:
+                    self._running -= 1
+                    # Задача не запустилась — токен пользователю возвращаем
+                    bucket = self._buckets.get(user_id)
+                    if not priority and bucket is not None:
+                        bucket.refund()
+                job.finished.set()
+                future.set_exception(e)
+                continue
+            engine_future.add_done_callback(lambda f, future=future: self._on_done(f, future))
+
+    def _on_done(self, engine_future, future):
+        with self._lock:
+            self._running -= 1
+        if engine_future.exception() is not None:
+            future.set_exception(engine_future.exception())
+        else:
+            future.set_result(engine_future.result())
+        self._dispatch()
@@ -0,0 +1,104 @@
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+
+from yt_dlp.extractor import gen_extractor_classes
+
+
+@lru_cache(maxsize=1024)
+def video_key_from_url(url: str):
+    """
+    Определяет 'Extractor:id' прямо по ссылке, без обращения к сети.
+    Возвращает None, если экстрактор не умеет вытаскивать id из ссылки.
+    """
+    for ie in gen_extractor_classes():
+        if ie.ie_key() == 'Generic' or not ie.suitable(url):
+            continue
+        try:
+            video_id = ie.get_temp_id(url)
+        except Exception:
+            video_id = None
+        return f"{ie.ie_key()}:{video_id}" if video_id else None
+    return None
+
+
+def video_key(url: str, info=None):
+    """
+    Ключ видео для кэша: сначала по ссылке, иначе по info-словарю yt-dlp.
+    """
+    key = video_key_from_url(url)
+    if key is None and info and info.get('id'):
+        key = f"{info.get('extractor_key', 'Generic')}:{info['id']}"
+    return key
+
+
+class FileIdCache:
+    """
+    Постоянный кэш Telegram file_id в SQLite.
+    Ключ — (видео, format_id, режим обработки); на ключ может быть несколько файлов (карусели).
+    Режим хранится строкой в колонке postprocess.
+    """
+
+    def __init__(self, db_path):
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS file_ids (
+                    video_key TEXT NOT NULL,
+                    format_id TEXT NOT NULL,
+                    postprocess INTEGER NOT NULL,
+                    position INTEGER NOT NULL,
+                    kind TEXT NOT NULL,
+                    file_id TEXT NOT NULL,
+                    title TEXT,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (video_key, format_id, postprocess, position)
+                )
+                """
+            )
+            # Записи из времён, когда режим был числом-флагом, ни с одним режимом не совпадут
+            self._conn.execute("DELETE FROM file_ids WHERE typeof(postprocess) = 'integer'")
+
+    def get(self, video_key, format_id, mode):
+        """
+        Возвращает список (kind, file_id, title) в порядке отправки или пустой список.
+        """
+        if not video_key:
+            return []
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT kind, file_id, title FROM file_ids "
+                "WHERE video_key = ? AND format_id = ? AND postprocess = ? ORDER BY position",
+                (video_key, format_id, mode)
+            ).fetchall()
+        return rows
+
+    def put(self, video_key, format_id, mode, items, title=''):
+        """
+        Сохраняет items — список (kind, file_id) — заменяя прежние записи по ключу.
+        """
+        if not video_key or not items:
+            return
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM file_ids WHERE video_key = ? AND format_id = ? AND postprocess = ?",
+                (video_key, format_id, mode)
+            )
+            self._conn.executemany(
+                "INSERT INTO file_ids VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (video_key, format_id, mode, position, kind, file_id, title, now)
+                    for position, (kind, file_id) in enumerate(items)
+                ]
+            )
+
+    def invalidate(self, video_key, format_id, mode):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM file_ids WHERE video_key = ? AND format_id = ? AND postprocess = ?",
+                (video_key, format_id, mode)
+            )
@@ -0,0 +1,115 @@
+import bisect
+
+# Насколько высота формата может отличаться от целевого разрешения
+RESOLUTION_TOLERANCE = 50
+
+# Контейнеры, которые склеиваются в mp4 без перекодирования
+MP4_VIDEO_EXTENSIONS = {'mp4'}
+MP4_AUDIO_EXTENSIONS = {'m4a', 'mp4'}
+
+
+def format_size(fmt, duration=None):
+    """
+    Размер формата в байтах: точный, примерный от yt-dlp или по битрейту и длительности. 0 — неизвестно.
+    """
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if size:
+        return int(size)
+    if fmt.get('tbr') and duration:
+        # tbr в кбит/с
+        return int(fmt['tbr'] * 1000 / 8 * duration)
+    return 0
+
+
+def has_video(fmt):
+    # Кодек не указан — считаем, что дорожка есть (так yt-dlp описывает обычные mp4)
+    return fmt.get('vcodec') != 'none'
+
+
+def has_audio(fmt):
+    return fmt.get('acodec') != 'none'
+
+
+def _audio_rank(fmt, duration):
+    # Сначала то, что клеится в mp4 без перекодирования, потом по битрейту
+    return (fmt.get('ext') in MP4_AUDIO_EXTENSIONS, fmt.get('abr') or fmt.get('tbr') or 0, format_size(fmt, duration))
+
+
+def best_audio(formats, duration=None):
+    """
+    Лучшая дорожка без видео для режима «только звук» или None.
+    """
+    audio = [fmt for fmt in formats if not has_video(fmt) and has_audio(fmt)]
+    return max(audio, key=lambda fmt: _audio_rank(fmt, duration), default=None)
+
+
+def build_format_ladder(formats, target_resolutions, duration=None, max_size=None):
+    """
+    За один проход по formats подбирает для каждого целевого разрешения лучший вариант.
+
+    Кандидаты — готовые mp4 со звуком и mp4-видео без звука, к которому добавляется лучшая
+    m4a-дорожка (формат вида "137+140", размер — сумма видео и звука). Другие дорожки
+    (webm/opus) не берём: с ними yt-dlp склеивает в mkv, а не в mp4. Из вариантов с
+    высотой в пределах ±RESOLUTION_TOLERANCE выбирается самый близкий, при равенстве — с
+    большим битрейтом. Если задан max_size, варианты с известным размером больше него
+    отбрасываются сразу, чтобы не предлагать то, что потом не отправится.
+
+    Возвращает (rungs, too_big): список словарей resolution/format_id/filesize/width/height
+    в порядке target_resolutions (без повторов одного формата) и сколько кандидатов
+    отброшено из-за размера.
+    """
+    targets = sorted(set(target_resolutions))
+    merge_audio = None
+    progressive = []
+    video_only = []
+    for fmt in formats:
+        if has_video(fmt):
+            if fmt.get('ext') not in MP4_VIDEO_EXTENSIONS or not fmt.get('height'):
+                continue
+            (progressive if has_audio(fmt) else video_only).append(fmt)
+        elif has_audio(fmt) and fmt.get('ext') in MP4_AUDIO_EXTENSIONS:
+            if merge_audio is None or _audio_rank(fmt, duration) > _audio_rank(merge_audio, duration):
+                merge_audio = fmt
+
+    audio_size = format_size(merge_audio, duration) if merge_audio else 0
+    candidates = [(fmt, fmt['format_id'], format_size(fmt, duration)) for fmt in progressive]
+    if merge_audio is not None:
+        for fmt in video_only:
+            video_size = format_size(fmt, duration)
+            size = video_size + audio_size if video_size else 0
+            candidates.append((fmt, f"{fmt['format_id']}+{merge_audio['format_id']}", size))
+
+    best = {}
+    too_big = 0
+    for fmt, format_id, size in candidates:
+        if max_size and size and size > max_size:
+            too_big += 1
+            continue
+        height = fmt['height']
+        rank = fmt.get('tbr') or 0
+        # Целевые разрешения в окне ±RESOLUTION_TOLERANCE (их одно, реже два)
+        start = bisect.bisect_left(targets, height - RESOLUTION_TOLERANCE)
+        end = bisect.bisect_right(targets, height + RESOLUTION_TOLERANCE)
+        for target in targets[start:end]:
+            key = (abs(height - target), -rank)
+            current = best.get(target)
+            if current is None or key < current[0]:
+                best[target] = (key, fmt, format_id, size)
+
+    rungs = []
+    seen = set()
+    for target in target_resolutions:
+        if target not in best:
+            continue
+        _, fmt, format_id, size = best[target]
+        if format_id in seen:
+            continue
+        seen.add(format_id)
+        rungs.append({
+            'resolution': target,
+            'format_id': format_id,
+            'filesize': size,
+            'width': fmt.get('width') or 0,
+            'height': fmt.get('height') or 0,
+        })
+    return rungs, too_big
@@ -0,0 +1,84 @@
+import shutil
+import threading
+
+# Протоколы yt-dlp, которые качаются кусками (DASH/HLS) и могут внешним загрузчиком
+EXTERNAL_PROTOCOLS = ('dash', 'm3u8')
+
+MB = 1024 * 1024
+
+
+class FragmentTuner:
+    """
+    Подбирает для каждой задачи число параллельных фрагментов (DASH/HLS) и размер HTTP-чанка.
+
+    - Общий бюджет соединений делится между активными задачами: одна задача получает
+      max_per_job, десять — по budget // 10, но не меньше одного.
+    - По завершённым фрагментным скачиваниям копится скользящая скорость на каждое
+      число соединений. Если меньшее число соединений даёт почти ту же скорость
+      (knee_share от лучшей), берём меньшее — остальное останется другим задачам.
+    - Размер чанка — примерно chunk_seconds секунд скачивания на наблюдаемой скорости.
+    """
+
+    def __init__(self, budget=16, max_per_job=8, knee_share=0.9, alpha=0.3,
+                 chunk_seconds=4, min_chunk=1 * MB, max_chunk=16 * MB, external_downloader=None):
+        self.budget = budget
+        self.max_per_job = max_per_job
+        self.knee_share = knee_share
+        self.alpha = alpha
+        self.chunk_seconds = chunk_seconds
+        self.min_chunk = min_chunk
+        self.max_chunk = max_chunk
+        self.external_downloader = external_downloader if external_downloader and shutil.which(external_downloader) else None
+        self._rates = {}
+        self._speed = None
+        self._lock = threading.Lock()
+
+    def fragments_for(self, active_jobs):
+        fair = max(1, min(self.max_per_job, self.budget // max(1, active_jobs)))
+        with self._lock:
+            tested = sorted(n for n in self._rates if n <= fair)
+            if not tested:
+                return fair
+            best = max(self._rates[n] for n in tested)
+            # Самое маленькое число соединений, которое уже даёт почти лучшую скорость
+            knee = next(n for n in tested if self._rates[n] >= self.knee_share * best)
+            if knee == tested[-1] and knee < fair:
+                # Больше соединений ещё не пробовали — может, канал ещё не упёрся
+                return min(fair, knee * 2)
+            return knee
+
+    def chunk_size(self):
+        with self._lock:
+            if not self._speed:
+                return self.max_chunk
+            return int(max(self.min_chunk, min(self.max_chunk, self._speed * self.chunk_seconds)))
+
+    def options(self, active_jobs):
+        """
+        Опции yt-dlp для новой задачи с учётом числа уже идущих задач.
+        """
+        fragments = self.fragments_for(active_jobs)
+        options = {
+            'concurrent_fragment_downloads': fragments,
+            'http_chunk_size': self.chunk_size(),
+        }
+        if self.external_downloader:
+            options['external_downloader'] = {protocol: self.external_downloader for protocol in EXTERNAL_PROTOCOLS}
+            if self.external_downloader == 'aria2c':
+                options['external_downloader_args'] = {
+                    'aria2c': ['-j', str(fragments), '-x', str(min(fragments, 16)), '-k', '1M']
+                }
+        return options
+
+    def observe(self, fragments, downloaded_bytes, elapsed, fragmented):
+        """
+        Сообщает результат скачивания. Кривую «соединения → скорость» учим только по фрагментным.
+        """
+        if elapsed <= 0 or downloaded_bytes <= 0:
+            return
+        speed = downloaded_bytes / elapsed
+        with self._lock:
+            self._speed = speed if self._speed is None else (1 - self.alpha) * self._speed + self.alpha * speed
+            if fragmented:
+                previous = self._rates.get(fragments)
+                self._rates[fragments] = speed if previous is None else (1 - self.alpha) * previous + self.alpha * speed
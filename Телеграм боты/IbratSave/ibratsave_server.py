@@ -3,39 +3,204 @@ import shutil
 import asyncio
 import logging
 import uuid
-import threading
+import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+from contextlib import ExitStack
 from urllib.parse import urlparse
 
-import telebot
 from telebot import types
+from telebot.async_telebot import AsyncTeleBot
 import yt_dlp
-
-# Папка для бота
-BASE_DIR = "/root/ibratsave"
-DOWNLOAD_DIR = os.path.join(BASE_DIR, "downloads")
+from yt_dlp.utils import DownloadCancelled, DownloadError, ReExtractInfo
+
+from download_engine import AUDIO_EXTENSIONS, DownloadEngine, EngineBusy, MEDIA_EXTENSIONS
+from download_store import DownloadStore
+from fair_scheduler import FairScheduler, RateLimited
+from file_id_cache import FileIdCache, video_key
+from format_ladder import best_audio, build_format_ladder, format_size
+from fragment_tuner import FragmentTuner
+from metadata_cache import MetadataCache, info_for_download
+from metrics import (
+    CACHE_LOOKUPS, ERRORS, EXTRACTIONS_IN_FLIGHT, PREFETCH_WASTED_BYTES, PREFETCHES, QUEUED_JOBS, RUNNING_JOBS,
+    STAGE_SECONDS, TRANSCODE_QUEUED, UPLOADED_BYTES, MetricsServer
+)
+from prefetch import ChoicePredictor, Prefetch, WasteBudget
+from single_flight import SingleFlight
+from progress_scheduler import ProgressEditScheduler
+from range_server import FileLinkServer
+from request_store import RequestStore
+from splitter import SPLIT_SAFETY, split_video
+from streamable import audio_meta, prepare_upload
+from webhook import WebhookServer
+from transcode import TRANSCODE_SOURCE_EXTENSIONS, fit_to_size, plan_fit, remux_audio, smart_transcode
+from transcode_pool import TranscodePool
+
+# Папка для бота (переменная окружения нужна, например, для loadtest.py)
+BASE_DIR = os.environ.get("IBRATSAVE_BASE_DIR", "/root/ibratsave")
+# У каждого процесса своя папка загрузок: уборщик STORE считает незнакомые папки брошенными
+# и удалил бы загрузки соседа. Процессы на одном BASE_DIR различаются IBRATSAVE_INSTANCE,
+# по умолчанию — портом webhook (он у каждого свой и не меняется между перезапусками).
+INSTANCE_NAME = os.environ.get("IBRATSAVE_INSTANCE") or (
+    f"webhook-{os.environ['IBRATSAVE_WEBHOOK_PORT']}" if os.environ.get("IBRATSAVE_WEBHOOK_PORT") else "main"
+)
+DOWNLOAD_DIR = os.path.join(BASE_DIR, "downloads", INSTANCE_NAME)
 if not os.path.exists(DOWNLOAD_DIR):
     os.makedirs(DOWNLOAD_DIR)
 VIDEO_DIR = DOWNLOAD_DIR
+# Превью для видео — вне DOWNLOAD_DIR, чтобы не попадать в медиафайлы задач
+THUMB_DIR = os.path.join(BASE_DIR, "thumbs")
 
 MAX_FILE_SIZE = 50 * 1024 * 1024  # 50 MB
+# Большие видео обычным юзерам режем на части (по ключевым кадрам, без перекодирования)
+PART_MAX_SIZE = 48 * 1024 * 1024  # с запасом под лимит
+MAX_SPLIT_PARTS = 10
+# Части целятся в SPLIT_SAFETY от PART_MAX_SIZE, поэтому и предел считаем от реального размера части
+MAX_SPLIT_SIZE = int(PART_MAX_SIZE * SPLIT_SAFETY * MAX_SPLIT_PARTS)
+# Режим «ужать под лимит»: перекодируем с битрейтом под длительность, чтобы влезло одним файлом
+FIT_TARGET_SIZE = 48 * 1024 * 1024
+# Что делаем со скачанным (режим входит в ключ кэша)
+MODE_NONE = 'none'            # отдаём как есть
+MODE_TRANSCODE = 'transcode'  # склеиваем в mp4 и перекодируем под Telegram
+MODE_FIT = 'fit'              # перекодируем так, чтобы влезло в FIT_TARGET_SIZE
+MODE_AUDIO = 'audio'          # только звук, без перекодирования
+# Кнопки, созданные до именованных режимов, хранят их числами
+LEGACY_MODES = {2: MODE_FIT, 3: MODE_AUDIO}
+DOWNLOAD_QUOTA = 10 * 1024 * 1024 * 1024  # 10 GB на всё хранилище скачанного
+JANITOR_INTERVAL = 60
+MAX_PARALLEL_DOWNLOADS = 4
+MAX_QUEUED_DOWNLOADS = 16
+# Перекодирование идёт в своём пуле: None — по числу ядер, по TRANSCODE_THREADS потоков ffmpeg на задачу
+TRANSCODE_WORKERS = None
+TRANSCODE_THREADS = 2
+# Сколько задач один пользователь может поставить разом и как быстро восстанавливается лимит
+USER_BURST = 5
+USER_REFILL_SECONDS = 20
+# DASH/HLS: сколько фрагментов качается параллельно на все задачи и на одну задачу;
+# внешний загрузчик (например, "aria2c") используется, только если он установлен
+FRAGMENT_CONNECTION_BUDGET = 16
+MAX_FRAGMENTS_PER_JOB = 8
+FRAGMENT_DOWNLOADER = None
+MAX_PARALLEL_EXTRACTIONS = 4
+MAX_QUEUED_EXTRACTIONS = 16
+INSTAGRAM_PARALLEL_ENTRIES = 4
+MEDIA_GROUP_SIZE = 10  # больше Telegram в один альбом не принимает
+# Лимиты Telegram: около 30 сообщений в секунду на бота и не чаще раза в секунду в один чат
+PROGRESS_EDITS_PER_SECOND = 20
+PROGRESS_EDIT_INTERVAL_PER_CHAT = 3
+# Какие разрешения предлагаем на клавиатуре (в этом порядке)
+TARGET_RESOLUTIONS = [360, 480, 720, 1080, 640, 848, 1280, 1920]
+# Пока юзер выбирает формат, заранее качаем самый вероятный (только когда есть свободные воркеры)
+PREFETCH_ENABLED = True
+PREFETCH_DEFAULT_RESOLUTION = 720
+PREFETCH_MAX_SIZE = 50 * 1024 * 1024
+PREFETCH_WASTE_BUDGET = 2 * 1024 * 1024 * 1024  # сколько байт в час можно скачать впустую
+PREFETCH_TTL = 10 * 60  # сколько ждём выбора, прежде чем считать догадку брошенной
+METADATA_TTL = 30 * 60  # ссылки на потоки YouTube живут несколько часов, берём с запасом
 
 ADMIN_IDS = {772482922}
 
-DOWNLOAD_REQUESTS = {}
-ADMIN_DELETE_REQUESTS = {}
-PROGRESS = {}
-
-BOT_TOKEN = ""
+# Встроенный файловый сервер для больших файлов админа (обычно за reverse proxy)
+FILE_SERVER_HOST = "127.0.0.1"
+FILE_SERVER_PORT = int(os.environ.get("IBRATSAVE_FILE_SERVER_PORT", 8088))
+FILE_SERVER_PUBLIC_URL = os.environ.get("IBRATSAVE_FILE_SERVER_PUBLIC_URL", f"http://127.0.0.1:{FILE_SERVER_PORT}")
+FILE_LINK_SECRET = ""  # пусто — случайный секрет, ссылки живут до перезапуска
+FILE_LINK_TTL = 6 * 60 * 60
+
+# Метрики для Prometheus (только локально, наружу не открывать)
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = int(os.environ.get("IBRATSAVE_METRICS_PORT", 9108))
+
+# Webhook вместо polling: включается, если задан публичный WEBHOOK_URL (https, за reverse proxy).
+# Несколько процессов могут слушать разные порты за одним прокси с общим BASE_DIR: повторы отсекаются
+# через общую базу, а загрузки у каждого в своей папке (см. INSTANCE_NAME).
+WEBHOOK_URL = os.environ.get("IBRATSAVE_WEBHOOK_URL", "")
+WEBHOOK_HOST = "127.0.0.1"
+WEBHOOK_PORT = int(os.environ.get("IBRATSAVE_WEBHOOK_PORT", 8081))
+WEBHOOK_PATH = "/telegram/webhook"
+# Обязателен в режиме webhook (A-Z, a-z, 0-9, _ и -, до 256 символов); общий для всех процессов за прокси
+WEBHOOK_SECRET = os.environ.get("IBRATSAVE_WEBHOOK_SECRET", "")
+WEBHOOK_WORKERS = 64  # сколько хендлеров работает одновременно
+WEBHOOK_DEDUP_TTL = 24 * 60 * 60  # Telegram хранит неотданные обновления сутки
+
+# Кнопки выбора формата и удаления файлов админа переживают перезапуск (SQLite)
+REQUEST_TTL = 24 * 60 * 60
+MAX_PENDING_REQUESTS = 10000
+REQUESTS_DB = os.path.join(BASE_DIR, "requests.sqlite3")
+SEEN_UPDATES = RequestStore(REQUESTS_DB, "seen_update", ttl=WEBHOOK_DEDUP_TTL, max_entries=MAX_PENDING_REQUESTS)
+DOWNLOAD_REQUESTS = RequestStore(REQUESTS_DB, "download", ttl=REQUEST_TTL, max_entries=MAX_PENDING_REQUESTS)
+ADMIN_DELETE_REQUESTS = RequestStore(REQUESTS_DB, "admin_delete", ttl=FILE_LINK_TTL, max_entries=MAX_PENDING_REQUESTS)
+CHOICES = ChoicePredictor(
+    RequestStore(REQUESTS_DB, "format_choice", ttl=365 * 24 * 60 * 60),
+    default=PREFETCH_DEFAULT_RESOLUTION
+)
+PREFETCH_WASTE = WasteBudget(PREFETCH_WASTE_BUDGET)
+PREFETCH_JOBS = {}
+FLIGHTS = SingleFlight()
+
+BOT_TOKEN = os.environ.get("IBRATSAVE_BOT_TOKEN", "")
+
+bot = AsyncTeleBot(BOT_TOKEN)
+ENGINE = DownloadEngine(DOWNLOAD_DIR, max_workers=MAX_PARALLEL_DOWNLOADS, max_queued=MAX_QUEUED_DOWNLOADS)
+SCHEDULER = FairScheduler(
+    ENGINE,
+    capacity=MAX_PARALLEL_DOWNLOADS,
+    max_queued=MAX_QUEUED_DOWNLOADS,
+    burst=USER_BURST,
+    refill_seconds=USER_REFILL_SECONDS
+)
+# yt-dlp блокирующий, поэтому экстракция идёт в отдельном пуле потоков, а не в event loop
+EXTRACT_EXECUTOR = ThreadPoolExecutor(max_workers=MAX_PARALLEL_EXTRACTIONS, thread_name_prefix="ibratsave-extract")
+EXTRACT_SLOTS = asyncio.Semaphore(MAX_PARALLEL_EXTRACTIONS + MAX_QUEUED_EXTRACTIONS)
+METADATA = MetadataCache(ttl=METADATA_TTL)
+FRAGMENTS = FragmentTuner(
+    budget=FRAGMENT_CONNECTION_BUDGET,
+    max_per_job=MAX_FRAGMENTS_PER_JOB,
+    external_downloader=FRAGMENT_DOWNLOADER
+)
+FILE_IDS = FileIdCache(os.path.join(BASE_DIR, "file_ids.sqlite3"))
+STORE = DownloadStore(DOWNLOAD_DIR, DOWNLOAD_QUOTA, janitor_interval=JANITOR_INTERVAL)
+FILE_SERVER = FileLinkServer(
+    FILE_SERVER_HOST,
+    FILE_SERVER_PORT,
+    FILE_SERVER_PUBLIC_URL,
+    secret=FILE_LINK_SECRET,
+    ttl=FILE_LINK_TTL,
+    on_expire=lambda key, path: remove_admin_file(key, path)
+)
+PROGRESS_EDITS = ProgressEditScheduler(
+    bot.edit_message_text,
+    global_rate=PROGRESS_EDITS_PER_SECOND,
+    per_chat_interval=PROGRESS_EDIT_INTERVAL_PER_CHAT
+)
+METRICS_SERVER = MetricsServer(METRICS_HOST, METRICS_PORT)
+TRANSCODER = TranscodePool(workers=TRANSCODE_WORKERS, threads_per_job=TRANSCODE_THREADS)
+QUEUED_JOBS.set_function(SCHEDULER.queued_count)
+TRANSCODE_QUEUED.set_function(TRANSCODER.waiting_count)
+RUNNING_JOBS.set_function(ENGINE.running_count)
+
+BUSY_TEXT = "Ух, сейчас очередь забита под завязку! Попробуй чуть позже 🚦🤡"
+
+
+def rate_limited_text(error):
+    return f"Эй, полегче! Ты кидаешь ссылки слишком часто 🐢 Следующую можно через {error.retry_in:.0f} сек."
+
+
+def extractor_name(url, info=None):
+    """
+    Имя экстрактора yt-dlp для метки в метриках ошибок.
+    """
+    key = video_key(url, info)
+    return key.split(':', 1)[0] if key else 'Generic'
 
-DOWNLOAD_FINISHED = False
 
-bot = telebot.TeleBot(BOT_TOKEN)
+def count_lookup(cache, hit):
+    CACHE_LOOKUPS.inc(cache=cache, result='hit' if hit else 'miss')
 
 
-def safe_edit_message_text(text, chat_id, message_id, reply_markup=None):
+async def safe_edit_message_text(text, chat_id, message_id, reply_markup=None):
     try:
-        bot.edit_message_text(text, chat_id, message_id, reply_markup=reply_markup)
+        await bot.edit_message_text(text, chat_id, message_id, reply_markup=reply_markup)
     except Exception as e:
         if "message is not modified" in str(e):
             pass
@@ -43,283 +208,833 @@ def safe_edit_message_text(text, chat_id, message_id, reply_markup=None):
             logging.error(f"Ошибка редактирования сообщения: {e}")
 
 
-def progress_hook(d):
-    """
-    Хук, вызываемый при скачивании (обновляет глобальный PROGRESS).
-    """
-    global PROGRESS
-    if d.get('status') == 'downloading':
-        PROGRESS = d
+def cancel_markup(job):
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton(text="Отмена", callback_data=f"cancel|{job.job_id}"))
+    return markup
 
 
-def download_video(url: str, format_id: str, do_postprocess: bool):
+def download_video(job, url: str, format_id: str, mode: str, info=None):
     """
-    Скачиваем видео:
-    - Если do_postprocess=True, включаем постпроцесс (FFmpeg: H.264 + AAC).
-    - Если False, скачиваем «как есть».
+    Скачиваем видео в папку задачи:
+    - MODE_TRANSCODE и MODE_FIT: склеиваем дорожки в mp4; перекодирование
+      делает следующий этап конвейера (transcode_files или fit_files в TRANSCODER).
+    - MODE_AUDIO: format_id — только звук, перекладываем его в m4a/opus без
+      перекодирования прямо здесь (это дёшево, очередь TRANSCODER не нужна).
+    - MODE_NONE: скачиваем «как есть».
+    Если передан info из кэша, повторной экстракции не делаем.
+    Название из info, с которым реально качали, кладём в job.title.
+    Число параллельных фрагментов и размер чанка подбирает FRAGMENTS.
     """
-    global DOWNLOAD_FINISHED
-    DOWNLOAD_FINISHED = False
-
+    download_opts = FRAGMENTS.options(ENGINE.running_count())
     ydl_opts = {
         'format': format_id,
-        'outtmpl': os.path.join(VIDEO_DIR, '%(title)s-%(id)s.%(ext)s'),
-        'progress_hooks': [progress_hook],
+        'outtmpl': os.path.join(job.work_dir, '%(title)s-%(id)s.%(ext)s'),
+        'progress_hooks': [job.progress_hook],
+        **download_opts,
     }
 
-    if do_postprocess:
+    if mode in (MODE_TRANSCODE, MODE_FIT):
+        ydl_opts['merge_output_format'] = 'mp4'
         ydl_opts['postprocessors'] = [
-            {
-                'key': 'FFmpegVideoConvertor',
-                'preferedformat': 'mp4'
-            },
             {
                 'key': 'FFmpegMetadata'
             }
         ]
-        ydl_opts['postprocessor_args'] = [
-            '-c:v', 'libx264',
-            '-c:a', 'aac',
-            '-preset', 'fast',
-            '-crf', '23'
-        ]
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        ydl.download([url])
+    started = time.monotonic()
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl, STAGE_SECONDS.time(stage='download'):
+        if info is None:
+            downloaded = ydl.extract_info(url)
+        else:
+            try:
+                downloaded = ydl.process_ie_result(info_for_download(info), download=True)
+            except (DownloadError, ReExtractInfo) as e:
+                # Ссылки на потоки могли протухнуть — качаем по исходной ссылке
+                logging.warning(f"Не удалось скачать по закэшированным данным, пробуем заново: {e}")
+                downloaded = ydl.extract_info(url)
+    job.title = (downloaded or {}).get('title', '')
+    FRAGMENTS.observe(
+        download_opts['concurrent_fragment_downloads'],
+        job.downloaded_bytes(),
+        time.monotonic() - started,
+        job.fragmented
+    )
+
+    if mode == MODE_AUDIO:
+        for f in sorted(os.listdir(job.work_dir)):
+            if not f.endswith('.part'):
+                remux_audio(os.path.join(job.work_dir, f), job.job_id)
+        print("Звук скачан!")
+        return
 
-    safe_edit_message_text("Качаем: ██████████ 100.0%\nЗагрузка завершена!", 0, 0)
-    DOWNLOAD_FINISHED = True
-    print("Видео скачано" + (", с перекодированием!" if do_postprocess else ", без перекодирования!"))
+    print("Видео скачано" + (", без перекодирования!" if mode == MODE_NONE else ", дальше перекодирование!"))
 
 
-def progress_updater(chat_id, message_id):
+def transcode_files(job, threads=None):
     """
-    Каждые 3 секунды пытается обновить сообщение о прогрессе.
+    Второй этап: приводим скачанные видео к H.264 + AAC в mp4 самым дешёвым способом
+    (см. transcode.smart_transcode). Выполняется в TRANSCODER, а не в пуле скачиваний.
     """
-    last_text = ""
-    while not DOWNLOAD_FINISHED:
-        time.sleep(3)
-        try:
-            if PROGRESS and PROGRESS.get('status') == 'downloading':
-                downloaded = PROGRESS.get('downloaded_bytes', 0)
-                total = PROGRESS.get('total_bytes') or PROGRESS.get('total_bytes_estimate', 0)
-                percent = (downloaded / total * 100) if total else 0
-                speed = PROGRESS.get('speed', 0)
-                eta = PROGRESS.get('eta', 0)
-                blocks = int(percent // 10)
-                progress_bar = '█' * blocks + '▒' * (10 - blocks)
-                text = (
-                    f"Качаем: {progress_bar} {percent:.1f}%\n"
-                    f"Загружено: {downloaded}/{total} байт\n"
-                    f"Скорость: {speed:.2f} B/s, ETA: {eta} сек"
-                )
-                if text != last_text:
-                    safe_edit_message_text(text, chat_id, message_id)
-                    last_text = text
-        except Exception as e:
-            logging.error(f"Ошибка обновления прогресса: {e}")
+    for f in sorted(os.listdir(job.work_dir)):
+        if job.cancelled:
+            raise DownloadCancelled(f"Задача {job.job_id} отменена")
+        if f.lower().endswith(TRANSCODE_SOURCE_EXTENSIONS):
+            smart_transcode(os.path.join(job.work_dir, f), job.job_id, threads=threads, cancel_event=job.cancel_event)
 
 
-def get_video_formats(url: str):
+def fit_files(job, threads=None):
     """
-    Возвращает список форматов, чтобы подобрать 360/480/720/1080p (mp4).
+    Второй этап для режима MODE_FIT: ужимаем каждое видео меньше FIT_TARGET_SIZE.
     """
-    ydl_opts = {'listformats': True, 'quiet': True}
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=False)
-        return info.get('formats', [])
+    for f in sorted(os.listdir(job.work_dir)):
+        if job.cancelled:
+            raise DownloadCancelled(f"Задача {job.job_id} отменена")
+        if f.lower().endswith(TRANSCODE_SOURCE_EXTENSIONS):
+            fit_to_size(
+                os.path.join(job.work_dir, f), FIT_TARGET_SIZE, job.job_id, threads=threads, cancel_event=job.cancel_event
+            )
 
 
-def select_format_by_resolution(formats, target_res):
+def transcode_stage(mode):
+    if mode == MODE_FIT:
+        return fit_files
+    if mode == MODE_TRANSCODE:
+        return transcode_files
+    return None
+
+
+def render_progress(job, cancellable=True):
     """
-    Находим mp4-формат, у которого высота ближе всего к target_res (±50).
+    Текст сообщения о прогрессе задачи для PROGRESS_EDITS; (None, None), если показывать нечего.
+    cancellable=False — без кнопки отмены (чужая задача, к которой подключились).
     """
-    candidates = []
-    for fmt in formats:
-        if fmt.get('ext') != 'mp4':
-            continue
-        height = fmt.get('height') or 0
-        diff = abs(height - target_res)
-        if diff <= 50:
-            candidates.append((fmt, diff))
-    if not candidates:
-        return None
-    best_fmt = min(candidates, key=lambda x: x[1])[0]
-    return best_fmt
+    markup = cancel_markup(job) if cancellable else None
+    transcode_position = TRANSCODER.position(job)
+    if transcode_position is not None:
+        text = (
+            "Скачано! Следующим перекодирую ⏳" if transcode_position == 0
+            else f"Скачано! Жду перекодирования: впереди {transcode_position} задач(и) ⏳"
+        )
+        return text, markup
+    if TRANSCODER.is_running(job):
+        return "Перекодирую видос под Telegram... ⚙️", markup
+    if job.finished.is_set():
+        return None, None
+    if not job.started.is_set():
+        position = SCHEDULER.position(job)
+        if position is None:
+            return None, None
+        text = "Ты следующий в очереди! ⏳" if position == 0 else f"Ты в очереди: впереди {position} задач(и) ⏳"
+        return text, markup
+    progress = job.get_progress()
+    if not progress or progress.get('status') != 'downloading':
+        return None, None
+    downloaded = progress.get('downloaded_bytes') or 0
+    total = progress.get('total_bytes') or progress.get('total_bytes_estimate') or 0
+    percent = (downloaded / total * 100) if total else 0
+    speed = progress.get('speed') or 0
+    eta = progress.get('eta') or 0
+    blocks = int(percent // 10)
+    progress_bar = '█' * blocks + '▒' * (10 - blocks)
+    text = (
+        f"Качаем: {progress_bar} {percent:.1f}%\n"
+        f"Загружено: {downloaded}/{total} байт\n"
+        f"Скорость: {speed:.2f} B/s, ETA: {eta} сек"
+    )
+    return text, markup
+
+
+def extract_video_info(url: str):
+    """
+    Возвращает info-словарь yt-dlp, по возможности из кэша METADATA.
+    """
+    hit = True
+
+    def extract():
+        nonlocal hit
+        hit = False
+        with yt_dlp.YoutubeDL({'quiet': True}) as ydl, STAGE_SECONDS.time(stage='extract'):
+            return ydl.sanitize_info(ydl.extract_info(url, download=False))
+    info = METADATA.get_or_extract(url, extract)
+    count_lookup('metadata', hit)
+    return info
+
+
+async def run_extraction(fn, *args):
+    """
+    Выполняет блокирующую экстракцию в EXTRACT_EXECUTOR.
+    Если очередь экстракций заполнена, сразу бросает EngineBusy.
+    """
+    if EXTRACT_SLOTS.locked():
+        raise EngineBusy("Очередь экстракций заполнена")
+    async with EXTRACT_SLOTS:
+        EXTRACTIONS_IN_FLIGHT.inc()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(EXTRACT_EXECUTOR, fn, *args)
+        finally:
+            EXTRACTIONS_IN_FLIGHT.dec()
 
 
-def download_instagram_post(url: str):
+def download_instagram_entry(job, entry, index):
     """
-    Скачивание Instagram-постов (не трогаем).
+    Скачивает один элемент карусели по уже извлечённому info, без повторной экстракции.
+    Номер в имени файла сохраняет порядок элементов поста.
     """
-    global DOWNLOAD_FINISHED
-    DOWNLOAD_FINISHED = False
     ydl_opts = {
-        'outtmpl': os.path.join(VIDEO_DIR, '%(title)s-%(id)s-%(playlist_index)s.%(ext)s'),
-        'progress_hooks': [progress_hook]
+        'outtmpl': os.path.join(job.work_dir, f'%(title)s-%(id)s-{index:02d}.%(ext)s'),
+        'progress_hooks': [job.progress_hook]
     }
     with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=False)
-        if 'entries' in info and info['entries']:
-            for entry in info['entries']:
-                if entry:
-                    ydl.download([entry['webpage_url']])
+        if entry.get('formats') or entry.get('url'):
+            ydl.process_ie_result(info_for_download(entry), download=True)
         else:
-            ydl.download([url])
-    DOWNLOAD_FINISHED = True
+            ydl.download([entry['webpage_url']])
+
+
+def download_instagram_post(job, url: str):
+    """
+    Скачивание Instagram-постов в папку задачи.
+    Элементы карусели качаются параллельно, не больше INSTAGRAM_PARALLEL_ENTRIES одновременно.
+    """
+    info = extract_video_info(url)
+    entries = [entry for entry in info.get('entries') or [] if entry]
+    if not entries:
+        download_instagram_entry(job, info, 1)
+        return info
+
+    with ThreadPoolExecutor(max_workers=INSTAGRAM_PARALLEL_ENTRIES, thread_name_prefix=f"ig-{job.job_id}") as pool, \
+            STAGE_SECONDS.time(stage='download'):
+        futures = [
+            pool.submit(download_instagram_entry, job, entry, index)
+            for index, entry in enumerate(entries, start=1)
+        ]
+        done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+        for future in done:
+            if future.exception() is not None:
+                # Останавливаем остальные элементы и пробрасываем ошибку
+                job.cancel()
+                raise future.exception()
     return info
 
 
-def download_instagram(message, url):
+def is_admin(user_id, chat_id):
+    """
+    Админ — если админ сам пользователь (в том числе в группе) или это чат админа.
+    """
+    return user_id in ADMIN_IDS or chat_id in ADMIN_IDS
+
+
+def start_job(user_id, chat_id, message_id, fn, *args, prefetch=False, transcode=None):
+    """
+    Создаёт задачу, ставит её в очередь SCHEDULER и подписывает её сообщение на PROGRESS_EDITS.
+    Если задан transcode (см. transcode_stage), после скачивания он выполняется в TRANSCODER.
+    Возвращает (job, future), future (весь конвейер) можно ждать через await.
+    Если очередь заполнена, бросает EngineBusy, если у пользователя кончился лимит — RateLimited.
+    Догадка (prefetch=True) идёт без приоритета, со своим лимитом и не показывает прогресс.
+    """
+    job = ENGINE.create_job(chat_id, message_id)
+    STORE.pin(job.work_dir, 'job')
+    priority = not prefetch and is_admin(user_id, chat_id)
+    try:
+        future = SCHEDULER.submit(f"prefetch:{user_id}" if prefetch else user_id, job, fn, *args, priority=priority)
+    except EngineBusy:
+        ENGINE.release(job, cleanup=False)
+        STORE.discard(job.work_dir)
+        raise
+    if transcode is not None:
+        future = TRANSCODER.chain(job, future, transcode)
+    if prefetch:
+        return job, asyncio.wrap_future(future)
+    PROGRESS_EDITS.track(chat_id, message_id, lambda: render_progress(job))
+    wrapped = asyncio.wrap_future(future)
+    wrapped.add_done_callback(lambda _: PROGRESS_EDITS.untrack(chat_id, message_id))
+    return job, wrapped
+
+
+def finish_job(job, store_key=None, title=''):
+    """
+    Отпускает задачу. Если store_key задан (всё скачано и лежит на диске) или файлы ждёт админ,
+    папка остаётся в STORE, иначе удаляется сразу.
+    """
+    ENGINE.release(job, cleanup=False)
+    STORE.unpin(job.work_dir, 'job')
+    if store_key is None and not STORE.is_pinned(job.work_dir):
+        STORE.discard(job.work_dir)
+    else:
+        STORE.adopt(job.work_dir, store_key, title=title)
+
+
+def fit_option(formats, duration):
+    """
+    Вариант «ужать под лимит»: (исходный rung, plan_fit) или None, если он не нужен
+    (всё и так влезает) или невозможен (размер или длительность неизвестны, видео слишком длинное).
+    Качаем самый маленький формат, которого хватает на высоту из плана, чтобы не тянуть лишнего.
+    """
+    rungs, _ = build_format_ladder(formats, TARGET_RESOLUTIONS, duration=duration)
+    rungs = sorted((r for r in rungs if r['filesize'] and r['height']), key=lambda r: r['height'])
+    if not rungs or rungs[-1]['filesize'] <= MAX_FILE_SIZE:
+        return None
+    plan = plan_fit(duration, FIT_TARGET_SIZE, rungs[-1]['height'])
+    if plan is None:
+        return None
+    source = next(r for r in rungs if r['height'] >= plan['height'])
+    if source['filesize'] <= MAX_FILE_SIZE:
+        # Этот формат и так влезает и уже есть на клавиатуре
+        return None
+    return source, plan
+
+
+def default_mode(filesize):
+    # Маленькие файлы перекодируем под Telegram, большие (админу или частями) отдаём как есть
+    return MODE_TRANSCODE if filesize and filesize <= MAX_FILE_SIZE else MODE_NONE
+
+
+async def run_prefetch(job, future, cache_key, title):
+    """
+    Ждёт догадку и кладёт результат в STORE под обычным ключом — оттуда его заберёт
+    process_download_callback, если пользователь выберет этот формат.
+    """
+    store_key = None
+    try:
+        await future
+        if job.media_files():
+            store_key = make_store_key(cache_key)
+    except Exception as e:
+        logging.info(f"Догадка {job.job_id} не скачалась: {e}")
+    finally:
+        finish_job(job, store_key, title)
+        FLIGHTS.land(cache_key)
+
+
+def start_prefetch(user_id, chat_id, message_id, url, info, rungs):
+    """
+    Начинает качать самый вероятный формат (по CHOICES), пока пользователь выбирает.
+    Только если есть свободные воркеры и бюджет на промахи не исчерпан.
+    """
+    if not PREFETCH_ENABLED or not PREFETCH_WASTE.allows():
+        return
+    if SCHEDULER.queued_count() or ENGINE.running_count() >= MAX_PARALLEL_DOWNLOADS:
+        return
+    candidates = {
+        rung['resolution']: rung for rung in rungs
+        if rung['filesize'] and rung['filesize'] <= PREFETCH_MAX_SIZE
+    }
+    resolution = CHOICES.predict(candidates)
+    if resolution is None:
+        return
+    rung = candidates[resolution]
+    mode = default_mode(rung['filesize'])
+    cache_key = (video_key(url, info), rung['format_id'], mode)
+    store_key = make_store_key(cache_key)
+    if cache_key in FLIGHTS or FILE_IDS.get(*cache_key) or (store_key and STORE.lookup(store_key)):
+        return
+    try:
+        job, future = start_job(
+            user_id, chat_id, message_id, download_video, url, rung['format_id'], mode, info,
+            prefetch=True, transcode=transcode_stage(mode)
+        )
+    except EngineBusy:
+        return
+    flight, _ = FLIGHTS.join(cache_key)
+    flight.job = job
+    task = asyncio.create_task(run_prefetch(job, future, cache_key, info.get('title', '')))
+    PREFETCH_JOBS[(chat_id, message_id)] = Prefetch(job, task, rung['format_id'], cache_key)
+    asyncio.get_running_loop().call_later(PREFETCH_TTL, expire_prefetch, chat_id, message_id)
+    PREFETCHES.inc(result='started')
+
+
+def drop_prefetch(prefetch, reason):
+    """
+    Отменяет ненужную догадку и списывает скачанное в бюджет промахов.
+    Если к догадке уже подключились другие пользователи, она докачивается для них.
+    """
+    flight = FLIGHTS.get(prefetch.cache_key)
+    if flight is not None and flight.waiters:
+        PREFETCHES.inc(result=reason)
+        return
+    # Скачанная догадка может ещё ждать перекодирования — отмена остановит и его
+    if not SCHEDULER.cancel(prefetch.job):
+        prefetch.job.cancel()
+    wasted = prefetch.job.downloaded_bytes()
+    PREFETCH_WASTE.spend(wasted)
+    PREFETCH_WASTED_BYTES.inc(wasted)
+    PREFETCHES.inc(result=reason)
+
+
+def expire_prefetch(chat_id, message_id):
+    prefetch = PREFETCH_JOBS.pop((chat_id, message_id), None)
+    if prefetch is not None:
+        drop_prefetch(prefetch, 'abandoned')
+
+
+async def wait_prefetch(prefetch, chat_id, message_id):
+    """
+    Пользователь выбрал угаданный формат: показываем прогресс догадки и ждём её.
+    Возвращает False, если пользователь её отменил.
+    """
+    PREFETCHES.inc(result='hit')
+    if not prefetch.task.done():
+        await safe_edit_message_text("Уже качаю этот видос! 🎬🔥", chat_id, message_id)
+        PROGRESS_EDITS.track(chat_id, message_id, lambda: render_progress(prefetch.job))
+        try:
+            await prefetch.task
+        finally:
+            PROGRESS_EDITS.untrack(chat_id, message_id)
+    return not prefetch.job.cancelled
+
+
+def make_store_key(cache_key):
+    video, format_id, mode = cache_key
+    if not video:
+        return None
+    return f"{video}|{format_id}|{mode}"
+
+
+def local_media_files(path):
+    return sorted(
+        os.path.join(path, f)
+        for f in os.listdir(path)
+        if f.lower().endswith(MEDIA_EXTENSIONS)
+    )
+
+
+async def prepare_video(file):
+    """
+    Готовит видео к отправке (faststart, размеры, длительность, превью) вне event loop.
+    Возвращает (опции для Telegram, путь к превью или None).
+    """
+    return await asyncio.to_thread(prepare_upload, file, THUMB_DIR, os.path.basename(os.path.dirname(file)))
+
+
+def remove_thumbnails(thumbnails):
+    for thumbnail in thumbnails:
+        if thumbnail and os.path.exists(thumbnail):
+            os.remove(thumbnail)
+
+
+async def send_media_file(chat_id, file, caption):
+    """
+    Отправляет файл с диска и возвращает (kind, file_id) для кэша или None.
+    Видео уходит с длительностью, размерами и превью, чтобы сразу играло в чате,
+    звук — через send_audio с названием и длительностью.
+    """
+    if media_kind(file) == 'video':
+        options, thumbnail = await prepare_video(file)
+        try:
+            with STAGE_SECONDS.time(stage='upload'), ExitStack() as stack:
+                video = stack.enter_context(open(file, 'rb'))
+                thumb = stack.enter_context(open(thumbnail, 'rb')) if thumbnail else None
+                sent = await bot.send_video(chat_id, video, caption=caption, thumbnail=thumb, **options)
+        finally:
+            remove_thumbnails([thumbnail])
+    elif media_kind(file) == 'audio':
+        options = await asyncio.to_thread(audio_meta, file, caption)
+        with STAGE_SECONDS.time(stage='upload'), open(file, 'rb') as audio:
+            sent = await bot.send_audio(chat_id, audio, caption=caption, **options)
+    else:
+        with STAGE_SECONDS.time(stage='upload'), open(file, 'rb') as photo:
+            sent = await bot.send_photo(chat_id, photo, caption=caption)
+    UPLOADED_BYTES.inc(os.path.getsize(file))
+    return sent_file_id(sent)
+
+
+def sent_file_id(sent):
+    if sent.video:
+        return 'video', sent.video.file_id
+    if sent.photo:
+        return 'photo', sent.photo[-1].file_id
+    if sent.audio:
+        return 'audio', sent.audio.file_id
+    return None
+
+
+def input_media(kind, media, caption=None, **options):
+    if kind == 'video':
+        return types.InputMediaVideo(media, caption=caption, **options)
+    if kind == 'audio':
+        return types.InputMediaAudio(media, caption=caption, **options)
+    return types.InputMediaPhoto(media, caption=caption)
+
+
+def media_kind(file):
+    if file.lower().endswith(AUDIO_EXTENSIONS):
+        return 'audio'
+    return 'video' if file.lower().endswith(('.mp4', '.mov')) else 'photo'
+
+
+async def send_media_group_files(chat_id, files, caption):
+    """
+    Отправляет файлы альбомами по MEDIA_GROUP_SIZE штук; подпись ставится на первый элемент.
+    Возвращает (kind, file_id) для каждого файла в том же порядке.
+    """
+    items = []
+    for start in range(0, len(files), MEDIA_GROUP_SIZE):
+        batch = files[start:start + MEDIA_GROUP_SIZE]
+        if len(batch) == 1:
+            items.append(await send_media_file(chat_id, batch[0], caption if start == 0 else None))
+            continue
+        # Видео альбома готовим параллельно
+        prepared = await asyncio.gather(*(
+            prepare_video(file) if media_kind(file) == 'video' else asyncio.sleep(0, ({}, None))
+            for file in batch
+        ))
+        try:
+            with ExitStack() as stack, STAGE_SECONDS.time(stage='upload'):
+                media = [
+                    input_media(
+                        media_kind(file),
+                        stack.enter_context(open(file, 'rb')),
+                        caption if start == 0 and i == 0 else None,
+                        **options,
+                        **({'thumbnail': stack.enter_context(open(thumbnail, 'rb'))} if thumbnail else {})
+                    )
+                    for i, (file, (options, thumbnail)) in enumerate(zip(batch, prepared))
+                ]
+                sent = await bot.send_media_group(chat_id, media)
+        finally:
+            remove_thumbnails(thumbnail for _, thumbnail in prepared)
+        UPLOADED_BYTES.inc(sum(os.path.getsize(file) for file in batch))
+        items.extend(sent_file_id(message) for message in sent)
+    return items
+
+
+async def send_cached_media(chat_id, items):
+    """
+    Пересылает файлы из кэша по file_id (несколько — альбомами). Возвращает False, если Telegram их не принял.
+    """
+    try:
+        if len(items) == 1:
+            kind, file_id, title = items[0]
+            if kind == 'video':
+                await bot.send_video(chat_id, file_id, caption=title)
+            elif kind == 'audio':
+                await bot.send_audio(chat_id, file_id, caption=title)
+            else:
+                await bot.send_photo(chat_id, file_id, caption=title)
+            return True
+        for start in range(0, len(items), MEDIA_GROUP_SIZE):
+            batch = items[start:start + MEDIA_GROUP_SIZE]
+            await bot.send_media_group(chat_id, [
+                input_media(kind, file_id, title if start == 0 and i == 0 else None)
+                for i, (kind, file_id, title) in enumerate(batch)
+            ])
+        return True
+    except Exception as e:
+        logging.error(f"Не удалось отправить из кэша file_id: {e}")
+        return False
+
+
+def is_private_copy(file, owned):
+    """
+    Можно ли менять файл на диске: он из папки своей задачи (owned) и его не ждёт админ
+    по ссылке (закреп admin:*). Файлы из хранилища, отданные повторно, не трогаем.
+    """
+    return owned and not any(reason.startswith('admin:') for reason in STORE.pins(os.path.dirname(file)))
+
+
+async def send_video_parts(chat_id, file, caption, owned=False):
+    """
+    Режет слишком большое видео на части меньше PART_MAX_SIZE и отправляет их по порядку.
+    Части заменяют файл в папке, только если это собственная копия задачи (см. is_private_copy),
+    иначе оригинал не трогаем: режем во временную папку и удаляем её после отправки.
+    Возвращает (kind, file_id) частей или None, если разрезать не вышло.
+    """
+    folder = os.path.dirname(file)
+    output_dir = None
+    if not is_private_copy(file, owned):
+        output_dir = tempfile.mkdtemp(prefix="split-", dir=DOWNLOAD_DIR)
+    try:
+        try:
+            parts = await asyncio.to_thread(
+                split_video, file, PART_MAX_SIZE, os.path.basename(folder), output_dir, MAX_SPLIT_PARTS
+            )
+        except Exception as e:
+            logging.error(f"Не удалось разрезать {file} на части: {e}")
+            return None
+        items = []
+        for index, part in enumerate(parts, start=1):
+            part_caption = f"{caption} (часть {index}/{len(parts)})" if caption else f"Часть {index}/{len(parts)}"
+            items.append(await send_media_file(chat_id, part, part_caption))
+        return items
+    finally:
+        if output_dir is not None:
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+
+async def deliver_files(chat_id, user_id, media_files, caption, too_big_text, owned=False):
+    """
+    Отправляет файлы в чат. Слишком большие видео обычным юзерам режем на части и шлём
+    серией, остальное слишком большое не отправляем (собственную копию задачи, owned=True,
+    ещё и удаляем); админу оставляем на сервере (закреплены в STORE до нажатия кнопки).
+    Несколько файлов уходят альбомами через send_media_group. Кто админ — см. is_admin.
+    Возвращает (sent_items, all_kept, complete, refused): (kind, file_id) отправленных, остались ли
+    на диске все файлы (или их части), ушло ли в Telegram всё целиком и был ли файл,
+    который не дошёл до юзера никак (ни файлом, ни частями, ни ссылкой).
+    """
+    to_send = []
+    series = []
+    all_kept = True
+    complete = True
+    refused = False
+    for file in media_files:
+        file_size = os.path.getsize(file)
+        if file_size >= MAX_FILE_SIZE:
+            if not is_admin(user_id, chat_id):
+                parts = await send_video_parts(chat_id, file, caption, owned) if media_kind(file) == 'video' else None
+                if parts is not None:
+                    series.extend(parts)
+                    continue
+                await asyncio.sleep(3)
+                await bot.send_message(chat_id, too_big_text)
+                if is_private_copy(file, owned):
+                    os.remove(file)
+                    all_kept = False
+                complete = False
+                refused = True
+            else:
+                complete = False
+                admin_key = str(uuid.uuid4())[:8]
+                STORE.pin(os.path.dirname(file), f"admin:{admin_key}")
+                link, expires = FILE_SERVER.create_link(admin_key, file)
+                # Запись живёт ровно столько же, сколько ссылка
+                ADMIN_DELETE_REQUESTS.put(admin_key, file, ttl=expires - time.time())
+                expires_text = time.strftime('%d.%m %H:%M', time.localtime(expires))
+                admin_markup = types.InlineKeyboardMarkup()
+                admin_markup.add(
+                    types.InlineKeyboardButton(
+                        text="Я скачал контент",
+                        callback_data=f"delete|{admin_key}"
+                    )
+                )
+                await bot.send_message(
+                    chat_id,
+                    f"Контент заскочил на сервер! Качай (можно с докачкой) до {expires_text}:\n{link}\n"
+                    f"Скачай и жми кнопку, как настоящий клоун! 🤡👉 Не нажмёшь — сам сотру, когда ссылка протухнет.",
+                    reply_markup=admin_markup
+                )
+        else:
+            to_send.append(file)
+    if len(to_send) > 1:
+        sent_items = await send_media_group_files(chat_id, to_send, caption)
+    else:
+        sent_items = [await send_media_file(chat_id, file, caption) for file in to_send]
+    sent_items.extend(series)
+    return sent_items, all_kept, complete, refused
+
+
+async def deliver_from_store(chat_id, user_id, cache_key):
+    """
+    Если такие файлы уже лежат в STORE, отдаёт их с диска без скачивания.
+    Возвращает None, если в STORE их нет, иначе — дошло ли до юзера всё (False, если
+    что-то оказалось слишком большим; файлы хранилища при этом не удаляются).
+    """
+    store_key = make_store_key(cache_key)
+    found = STORE.lookup(store_key) if store_key else None
+    count_lookup('store', found is not None)
+    if found is None:
+        return None
+    path, title = found
+    reason = f"delivery:{uuid.uuid4()}"
+    STORE.pin(path, reason)
+    try:
+        media_files = local_media_files(path)
+        sent_items, _, complete, refused = await deliver_files(chat_id, user_id, media_files, title, "Контент слишком огромный для прямой отправки! 🎪😲")
+        if sent_items and complete and all(sent_items):
+            FILE_IDS.put(*cache_key, sent_items, title=title)
+        return not refused
+    finally:
+        STORE.unpin(path, reason)
+        STORE.refresh(path)
+
+
+async def download_instagram(message, url):
     """
     Отдельная функция для Instagram — возвращаем шуточные тексты.
     """
-    status_msg = bot.send_message(message.chat.id, "Стартуем! Начинаю качать этот сумасшедший пост... 🤡🚀")
-    progress_thread = threading.Thread(target=progress_updater, args=(message.chat.id, status_msg.message_id), daemon=True)
-    progress_thread.start()
+    cache_key = (video_key(url), 'post', MODE_NONE)
+    # Вирусный пост часто присылают несколько человек сразу — качаем его один раз (single-flight)
+    status_msg = None
+    while True:
+        if await deliver_cached(message.chat.id, message.from_user.id, status_msg and status_msg.message_id, cache_key):
+            return
+        flight, leader = FLIGHTS.join(cache_key)
+        count_lookup('inflight', not leader)
+        if leader:
+            break
+        if status_msg is None:
+            status_msg = await bot.send_message(message.chat.id, "Этот пост уже качается, подключаюсь! ⏳🔗")
+        await wait_flight(flight, message.chat.id, status_msg.message_id)
+
+    try:
+        await download_instagram_post_and_deliver(message, url, cache_key, flight, status_msg)
+    finally:
+        FLIGHTS.land(cache_key)
+
+
+async def download_instagram_post_and_deliver(message, url, cache_key, flight, status_msg=None):
+    """
+    Качает пост как ведущий single-flight и отправляет его; результат остаётся в кэшах
+    для тех, кто подключился к flight.
+    """
+    start_text = "Стартуем! Начинаю качать этот сумасшедший пост... 🤡🚀"
+    if status_msg is None:
+        status_msg = await bot.send_message(message.chat.id, start_text)
+    else:
+        await safe_edit_message_text(start_text, message.chat.id, status_msg.message_id)
+    try:
+        job, future = start_job(message.from_user.id, message.chat.id, status_msg.message_id, download_instagram_post, url)
+    except RateLimited as e:
+        await safe_edit_message_text(rate_limited_text(e), message.chat.id, status_msg.message_id)
+        return
+    except EngineBusy:
+        await safe_edit_message_text(BUSY_TEXT, message.chat.id, status_msg.message_id)
+        return
+    flight.job = job
 
+    store_key = None
+    title = ''
     try:
-        info = download_instagram_post(url)
+        info = await future
         title = info.get('title', '')
-        media_files = [
-            os.path.join(VIDEO_DIR, f)
-            for f in os.listdir(VIDEO_DIR)
-            if f.lower().endswith(('.mp4', '.mov', '.jpg', '.jpeg', '.png'))
-        ]
+        media_files = job.media_files()
         if not media_files:
-            time.sleep(3)
-            bot.edit_message_text("Ой-ой! Пост скачан, но файлы затерялись... 🤷‍♂️🙈", message.chat.id, status_msg.message_id)
+            await asyncio.sleep(3)
+            await bot.edit_message_text("Ой-ой! Пост скачан, но файлы затерялись... 🤷‍♂️🙈", message.chat.id, status_msg.message_id)
             return
 
-        bot.edit_message_text("Бах! Пост готов, закидываю файлы к тебе! 🎉🤡", message.chat.id, status_msg.message_id)
+        await bot.edit_message_text("Бах! Пост готов, закидываю файлы к тебе! 🎉🤡", message.chat.id, status_msg.message_id)
 
-        for file in media_files:
-            file_size = os.path.getsize(file)
-            if file_size >= MAX_FILE_SIZE:
-                if message.chat.id not in ADMIN_IDS:
-                    time.sleep(3)
-                    bot.send_message(
-                        message.chat.id,
-                        "Ого, этот пост настолько гигантский, что не могу его прям закинуть! 😱📏"
-                    )
-                    if os.path.isdir(file):
-                        shutil.rmtree(file, ignore_errors=True)
-                    else:
-                        os.remove(file)
-                else:
-                    admin_key = str(uuid.uuid4())[:8]
-                    ADMIN_DELETE_REQUESTS[admin_key] = file
-                    admin_markup = types.InlineKeyboardMarkup()
-                    admin_markup.add(
-                        types.InlineKeyboardButton(
-                            text="Я скачал контент",
-                            callback_data=f"delete|{admin_key}"
-                        )
-                    )
-                    bot.send_message(
-                        message.chat.id,
-                        f"Контент заскочил на сервер: {file}\nСкачай и жми кнопку, как настоящий клоун! 🤡👉",
-                        reply_markup=admin_markup
-                    )
-            else:
-                if file.lower().endswith(('.mp4', '.mov')):
-                    with open(file, 'rb') as video:
-                        bot.send_video(message.chat.id, video, caption=title)
-                else:
-                    with open(file, 'rb') as photo:
-                        bot.send_photo(message.chat.id, photo, caption=title)
-
-        time.sleep(10)
-        admin_files = set(ADMIN_DELETE_REQUESTS.values())
-        for f in os.listdir(VIDEO_DIR):
-            file_path = os.path.join(VIDEO_DIR, f)
-            if file_path in admin_files:
-                continue
-            try:
-                if os.path.isdir(file_path):
-                    shutil.rmtree(file_path, ignore_errors=True)
-                else:
-                    os.remove(file_path)
-            except Exception as del_e:
-                logging.error(f"Ошибка при удалении файла {file_path}: {del_e}")
+        sent_items, all_kept, complete, _ = await deliver_files(
+            message.chat.id,
+            message.from_user.id,
+            media_files,
+            title,
+            "Ого, этот пост настолько гигантский, что не могу его прям закинуть! 😱📏",
+            owned=True
+        )
+
+        # Кэшируем только если весь пост ушёл в Telegram целиком
+        if sent_items and complete and all(sent_items):
+            FILE_IDS.put(*cache_key, sent_items, title=title)
+        if all_kept:
+            store_key = make_store_key(cache_key)
 
+    except DownloadCancelled:
+        await safe_edit_message_text("Скачивание отменено! 🛑🤡", message.chat.id, status_msg.message_id)
     except Exception as e:
-        bot.edit_message_text(f"Ой-ой, произошла ошибка при качании поста! 😵‍💫 {e}", message.chat.id, status_msg.message_id)
+        ERRORS.inc(extractor=extractor_name(url), stage='download')
+        await bot.edit_message_text(f"Ой-ой, произошла ошибка при качании поста! 😵‍💫 {e}", message.chat.id, status_msg.message_id)
+    finally:
+        finish_job(job, store_key, title)
 
 
 @bot.message_handler(commands=["start"])
-def start_handler(message: types.Message):
+async def start_handler(message: types.Message):
     welcome_text = (
         "Йо, привет! 🤡🎉\n\n"
         "Я — Ibratsave, твой безбашенный клоун-бот для скачивания постов с видосами и фотками! 🤪📸🎥\n"
         "Скинь мне ссылку на пост (VK, Instagram, YouTube – всё, что душе угодно 😜) и смотри, как я превращаю контент в магию! 🚀💥\n\nСохраните видео на устройство, чтобы восстановить его первичный облик!\n\n"
-        "Если файл больше 50 MB, обычным юзерам он не доступен! 🗑️🤡 Но админам можно. 🔑"
+        f"Если видос больше 50 MB, пришлю его частями (до {MAX_SPLIT_PARTS} штук) или ужму в один файл! ✂️🤡 "
+        "Ещё больше — только админам. 🔑"
     )
-    bot.send_message(message.chat.id, welcome_text)
+    await bot.send_message(message.chat.id, welcome_text)
 
 
 @bot.message_handler(func=lambda message: 'http' in message.text)
-def link_handler(message: types.Message):
+async def link_handler(message: types.Message):
     url = message.text.strip()
 
     # Проверяем Instagram
     if "instagram.com" in url:
-        download_instagram(message, url)
+        await download_instagram(message, url)
         return
 
     # Иначе пробуем YouTube / другое
-    status_msg = bot.send_message(message.chat.id, "Стартуем! Начинаю проверять форматы... 🎬🔥")
+    status_msg = await bot.send_message(message.chat.id, "Стартуем! Начинаю проверять форматы... 🎬🔥")
     try:
-        all_formats = get_video_formats(url)
+        info = await run_extraction(extract_video_info, url)
+        all_formats = info.get('formats') or []
         if not all_formats:
-            bot.edit_message_text(
+            await bot.edit_message_text(
                 "Упс... Не удалось найти форматы для этого видео. 😕",
                 message.chat.id,
                 status_msg.message_id
             )
             return
 
-        target_resolutions = [360, 480, 720, 1080, 640, 848, 1280, 1920]
+        # Обычным юзерам не предлагаем то, что не влезет даже частями
+        admin = is_admin(message.from_user.id, message.chat.id)
+        rungs, too_big = build_format_ladder(
+            all_formats,
+            TARGET_RESOLUTIONS,
+            duration=info.get('duration'),
+            max_size=None if admin else MAX_SPLIT_SIZE
+        )
         markup = types.InlineKeyboardMarkup()
-        any_found = False
-
-        for res in target_resolutions:
-            fmt = select_format_by_resolution(all_formats, res)
-            if fmt:
-                fid = fmt.get('format_id')
-                filesize = fmt.get('filesize') or fmt.get('filesize_approx') or 0
-                height = fmt.get('height') or 0
-                width = fmt.get('width') or 0
-                size_mb = f"{filesize/(1024*1024):.1f} MB" if filesize else "N/A"
-
-                key = str(uuid.uuid4())[:8]
-                DOWNLOAD_REQUESTS[key] = (fid, url, filesize)
-
-                btn_text = f"{res}p (ID {fid}) | {width}x{height} | {size_mb}"
-                markup.add(
-                    types.InlineKeyboardButton(
-                        text=btn_text,
-                        callback_data=f"download|{key}"
-                    )
+
+        for rung in rungs:
+            fid = rung['format_id']
+            filesize = rung['filesize']
+            size_mb = f"{filesize/(1024*1024):.1f} MB" if filesize else "N/A"
+
+            key = str(uuid.uuid4())[:8]
+            DOWNLOAD_REQUESTS[key] = (fid, url, filesize, rung['resolution'])
+
+            btn_text = f"{rung['resolution']}p (ID {fid}) | {rung['width']}x{rung['height']} | {size_mb}"
+            markup.add(
+                types.InlineKeyboardButton(
+                    text=btn_text,
+                    callback_data=f"download|{key}"
                 )
-                any_found = True
+            )
 
-        if not any_found:
-            bot.edit_message_text(
-                "Не нашлось подходящих mp4-форматов на 360/480/720/1080p. 😵‍💫",
-                message.chat.id,
-                status_msg.message_id
+        audio = best_audio(all_formats, info.get('duration'))
+        audio_size = format_size(audio, info.get('duration')) if audio is not None else None
+        # Звук частями не режем, так что не-админам только то, что влезает одним файлом
+        if audio is not None and (admin or not audio_size or audio_size <= MAX_FILE_SIZE):
+            key = str(uuid.uuid4())[:8]
+            DOWNLOAD_REQUESTS[key] = (audio['format_id'], url, audio_size, None, MODE_AUDIO)
+            size_mb = f"{audio_size/(1024*1024):.1f} MB" if audio_size else "N/A"
+            markup.add(
+                types.InlineKeyboardButton(
+                    text=f"🎧 Только звук ({audio.get('ext')}) | {size_mb}",
+                    callback_data=f"download|{key}"
+                )
             )
+
+        fit = fit_option(all_formats, info.get('duration'))
+        if fit is not None:
+            source, plan = fit
+            key = str(uuid.uuid4())[:8]
+            DOWNLOAD_REQUESTS[key] = (source['format_id'], url, plan['size'], plan['height'], MODE_FIT)
+            markup.add(
+                types.InlineKeyboardButton(
+                    text=f"🎯 {plan['height']}p одним файлом | до {plan['size']/(1024*1024):.1f} MB",
+                    callback_data=f"download|{key}"
+                )
+            )
+
+        if not rungs and fit is None and audio is None:
+            text = "Не нашлось подходящих mp4-форматов на 360/480/720/1080p. 😵‍💫"
+            if too_big:
+                text = "Все форматы этого видоса слишком огромные — даже по частям не закинуть! 😱📏"
+            await bot.edit_message_text(text, message.chat.id, status_msg.message_id)
             return
 
-        bot.edit_message_text(
+        await bot.edit_message_text(
             "Выбери формат для скачивания видоса:",
             message.chat.id,
             status_msg.message_id,
             reply_markup=markup
         )
+        start_prefetch(message.from_user.id, message.chat.id, status_msg.message_id, url, info, rungs)
 
+    except EngineBusy:
+        await safe_edit_message_text(BUSY_TEXT, message.chat.id, status_msg.message_id)
     except Exception as e:
-        bot.edit_message_text(
+        ERRORS.inc(extractor=extractor_name(url), stage='extract')
+        await bot.edit_message_text(
             f"Упс, ошибка при получении форматов! 😵 {e}",
             message.chat.id,
             status_msg.message_id
@@ -327,22 +1042,31 @@ def link_handler(message: types.Message):
 
 
 @bot.callback_query_handler(func=lambda call: call.data and call.data.startswith("download|"))
-def process_download_callback(call: types.CallbackQuery):
+async def process_download_callback(call: types.CallbackQuery):
     data = call.data.split("|")
     if len(data) < 2:
         return
 
-    key = data[1]
-    if key not in DOWNLOAD_REQUESTS:
-        bot.send_message(call.message.chat.id, "Запрос просрочен или недействителен! ⏰🤡")
+    request = DOWNLOAD_REQUESTS.pop(data[1])
+    if request is None:
+        await bot.send_message(call.message.chat.id, "Запрос просрочен или недействителен! ⏰🤡")
         return
 
-    format_id, url, filesize = DOWNLOAD_REQUESTS.pop(key)
+    # Кнопки, созданные до появления догадок, хранят только три поля;
+    # у особых режимов (ужать под лимит, только звук) пятое поле — режим
+    format_id, url, filesize, *rest = request
     msg = call.message
-
-    # Если не админ и размер > 50MB
-    if filesize and filesize > MAX_FILE_SIZE and (msg.chat.id not in ADMIN_IDS):
-        bot.edit_message_text(
+    mode = LEGACY_MODES.get(rest[1], rest[1]) if len(rest) > 1 else None
+    if rest and mode is None:
+        CHOICES.record(rest[0])
+    prefetch = PREFETCH_JOBS.pop((msg.chat.id, msg.message_id), None)
+
+    # Если не админ и даже частями не влезет (звук частями не режем — для него лимит одного файла)
+    size_limit = MAX_FILE_SIZE if mode == MODE_AUDIO else MAX_SPLIT_SIZE
+    if filesize and filesize > size_limit and not is_admin(call.from_user.id, msg.chat.id):
+        if prefetch is not None:
+            drop_prefetch(prefetch, 'miss')
+        await bot.edit_message_text(
             "Ого, этот пост настолько гигантский, что не могу его прям закинуть! 😱📏",
             msg.chat.id,
             msg.message_id
@@ -350,112 +1074,244 @@ def process_download_callback(call: types.CallbackQuery):
         return
 
     # Для админов > 50MB (или юзеров < 50MB) решаем — перекодировать или нет
-    do_postprocess = False
-    if filesize and filesize <= MAX_FILE_SIZE:
-        do_postprocess = True  # Для маленьких файлов включим перекодирование
+    if mode is None:
+        mode = default_mode(filesize)
+
+    info = METADATA.get(url)
+    cache_key = (video_key(url, info), format_id, mode)
+    if prefetch is not None:
+        if prefetch.cache_key != cache_key:
+            drop_prefetch(prefetch, 'miss')
+        elif not await wait_prefetch(prefetch, msg.chat.id, msg.message_id):
+            await safe_edit_message_text("Скачивание отменено! 🛑🤡", msg.chat.id, msg.message_id)
+            return
+    # Если этот же видос в этом же формате уже качается для кого-то — ждём его и берём результат из кэша
+    while True:
+        if await deliver_cached(msg.chat.id, call.from_user.id, msg.message_id, cache_key):
+            return
+        flight, leader = FLIGHTS.join(cache_key)
+        count_lookup('inflight', not leader)
+        if leader:
+            break
+        await safe_edit_message_text("Этот видос уже качается, подключаюсь! ⏳🔗", msg.chat.id, msg.message_id)
+        await wait_flight(flight, msg.chat.id, msg.message_id)
 
-    bot.edit_message_text("Стартуем качать видос! 🎬🔥", msg.chat.id, msg.message_id)
+    try:
+        await download_and_deliver(call.from_user.id, msg, url, format_id, mode, info, cache_key, flight)
+    finally:
+        FLIGHTS.land(cache_key)
 
-    progress_thread = threading.Thread(
-        target=progress_updater,
-        args=(msg.chat.id, msg.message_id),
-        daemon=True
-    )
-    progress_thread.start()
 
+async def wait_flight(flight, chat_id, message_id):
+    """
+    Ждёт чужую задачу single-flight, показывая её прогресс (без кнопки отмены — задача не наша).
+    """
+    if flight.job is not None:
+        job = flight.job
+        PROGRESS_EDITS.track(chat_id, message_id, lambda: render_progress(job, cancellable=False))
     try:
-        download_video(url, format_id, do_postprocess)
+        await flight.wait()
+    finally:
+        PROGRESS_EDITS.untrack(chat_id, message_id)
 
-        info = yt_dlp.YoutubeDL({'quiet': True}).extract_info(url, download=False)
-        video_title = info.get('title', '')
 
-        media_files = [
-            os.path.join(VIDEO_DIR, f)
-            for f in os.listdir(VIDEO_DIR)
-            if f.lower().endswith(('.mp4', '.mov', '.jpg', '.jpeg', '.png'))
-        ]
+async def deliver_cached(chat_id, user_id, message_id, cache_key):
+    """
+    Отправляет видос из кэша file_id или из хранилища. True, если получилось.
+    message_id — статусное сообщение, которое нужно обновить (None — его нет).
+    """
+    cached = FILE_IDS.get(*cache_key)
+    count_lookup('file_id', bool(cached))
+    if cached:
+        if await send_cached_media(chat_id, cached):
+            if message_id is not None:
+                await safe_edit_message_text("Видос уже был у меня, держи! ⚡🎉", chat_id, message_id)
+            return True
+        FILE_IDS.invalidate(*cache_key)
+    delivered = await deliver_from_store(chat_id, user_id, cache_key)
+    if delivered is None:
+        return False
+    if message_id is not None:
+        text = "Видос уже был у меня, держи! ⚡🎉" if delivered else "Видос уже был у меня, но целиком не пролезает! 😬📏"
+        await safe_edit_message_text(text, chat_id, message_id)
+    return True
+
+
+async def download_and_deliver(user_id, msg, url, format_id, mode, info, cache_key, flight):
+    """
+    Качает видос как ведущий single-flight и отправляет его; результат остаётся в кэшах
+    для тех, кто подключился к flight.
+    """
+    await bot.edit_message_text("Стартуем качать видос! 🎬🔥", msg.chat.id, msg.message_id)
+
+    try:
+        job, future = start_job(
+            user_id, msg.chat.id, msg.message_id, download_video, url, format_id, mode, info,
+            transcode=transcode_stage(mode)
+        )
+    except RateLimited as e:
+        await safe_edit_message_text(rate_limited_text(e), msg.chat.id, msg.message_id)
+        return
+    except EngineBusy:
+        await safe_edit_message_text(BUSY_TEXT, msg.chat.id, msg.message_id)
+        return
+    flight.job = job
+
+    store_key = None
+    video_title = ''
+    try:
+        await future
+
+        # Название берём из того, что уже есть, — ещё одна экстракция после готовой загрузки не нужна
+        video_title = (info or {}).get('title') or job.title
+
+        media_files = job.media_files()
         if not media_files:
-            time.sleep(3)
-            bot.edit_message_text("Ой! Видос скачан, но файлы где-то исчезли... 🤔", msg.chat.id, msg.message_id)
+            await asyncio.sleep(3)
+            await bot.edit_message_text("Ой! Видос скачан, но файлы где-то исчезли... 🤔", msg.chat.id, msg.message_id)
             return
 
-        bot.edit_message_text("Видос готов! Закидываю файлы к тебе! 🚀🎉", msg.chat.id, msg.message_id)
-
-        for file in media_files:
-            file_size = os.path.getsize(file)
-            if file_size >= MAX_FILE_SIZE:
-                if msg.chat.id not in ADMIN_IDS:
-                    time.sleep(3)
-                    bot.send_message(msg.chat.id, "Контент слишком огромный для прямой отправки! 🎪😲")
-                    if os.path.isdir(file):
-                        shutil.rmtree(file, ignore_errors=True)
-                    else:
-                        os.remove(file)
-                else:
-                    admin_key = str(uuid.uuid4())[:8]
-                    ADMIN_DELETE_REQUESTS[admin_key] = file
-                    admin_markup = types.InlineKeyboardMarkup()
-                    admin_markup.add(
-                        types.InlineKeyboardButton(
-                            text="Я скачал контент",
-                            callback_data=f"delete|{admin_key}"
-                        )
-                    )
-                    bot.send_message(
-                        msg.chat.id,
-                        f"Контент заскочил на сервер: {file}\nСкачай и жми кнопку, как настоящий клоун! 🤡👉",
-                        reply_markup=admin_markup
-                    )
-            else:
-                if file.lower().endswith(('.mp4', '.mov')):
-                    with open(file, 'rb') as video:
-                        bot.send_video(msg.chat.id, video, caption=video_title)
-                else:
-                    with open(file, 'rb') as photo:
-                        bot.send_photo(msg.chat.id, photo, caption=video_title)
-
-        time.sleep(10)
-        admin_files = set(ADMIN_DELETE_REQUESTS.values())
-        for f in os.listdir(VIDEO_DIR):
-            file_path = os.path.join(VIDEO_DIR, f)
-            if file_path in admin_files:
-                continue
-            try:
-                if os.path.isdir(file_path):
-                    shutil.rmtree(file_path, ignore_errors=True)
-                else:
-                    os.remove(file_path)
-            except Exception as del_e:
-                logging.error(f"Ошибка при удалении файла {file_path}: {del_e}")
+        await bot.edit_message_text("Видос готов! Закидываю файлы к тебе! 🚀🎉", msg.chat.id, msg.message_id)
+
+        sent_items, all_kept, complete, _ = await deliver_files(
+            msg.chat.id,
+            user_id,
+            media_files,
+            video_title,
+            "Контент слишком огромный для прямой отправки! 🎪😲",
+            owned=True
+        )
+
+        if sent_items and complete and all(sent_items):
+            FILE_IDS.put(*cache_key, sent_items, title=video_title)
+        if all_kept:
+            store_key = make_store_key(cache_key)
 
+    except DownloadCancelled:
+        await safe_edit_message_text("Скачивание отменено! 🛑🤡", msg.chat.id, msg.message_id)
     except Exception as e:
-        bot.edit_message_text(f"Ой-ой, произошла ошибка при качании видоса! 😵‍💫 {e}", msg.chat.id, msg.message_id)
+        ERRORS.inc(extractor=extractor_name(url, info), stage='download')
+        await bot.edit_message_text(f"Ой-ой, произошла ошибка при качании видоса! 😵‍💫 {e}", msg.chat.id, msg.message_id)
+    finally:
+        finish_job(job, store_key, video_title)
 
 
-@bot.callback_query_handler(func=lambda call: call.data and call.data.startswith("delete|"))
-def delete_video_callback(call: types.CallbackQuery):
+@bot.callback_query_handler(func=lambda call: call.data and call.data.startswith("cancel|"))
+async def cancel_download_callback(call: types.CallbackQuery):
     data = call.data.split("|")
     if len(data) < 2:
         return
 
-    key = data[1]
-    if key not in ADMIN_DELETE_REQUESTS:
-        bot.send_message(call.message.chat.id, "Запрос просрочен или недействителен! ⏰🤡")
+    job = ENGINE.get_job(data[1])
+    if job is None or job.chat_id != call.message.chat.id:
+        await bot.answer_callback_query(call.id, "Задача уже завершена! ⏰🤡")
         return
 
-    file_path = ADMIN_DELETE_REQUESTS.pop(key)
-    if os.path.exists(file_path):
+    # Ещё не начатую задачу просто убираем из очереди, начатую — прерываем
+    if not SCHEDULER.cancel(job):
+        job.cancel()
+    await bot.answer_callback_query(call.id, "Отменяю скачивание... 🛑")
+
+
+def remove_admin_file(key, file_path=None):
+    """
+    Удаляет файл, отложенный для админа, и гасит ссылку на него.
+    file_path нужен, когда запись уже просрочена (вызов из FILE_SERVER по истечении ссылки).
+    Возвращает True, если файл ещё был на диске.
+    """
+    file_path = ADMIN_DELETE_REQUESTS.pop(key) or file_path
+    FILE_SERVER.revoke(key)
+    if file_path is None:
+        return False
+    existed = os.path.exists(file_path)
+    if existed:
         if os.path.isdir(file_path):
             shutil.rmtree(file_path, ignore_errors=True)
         else:
             os.remove(file_path)
-        bot.edit_message_text("Контент стер с сервера! 🗑️💥", call.message.chat.id, call.message.message_id)
+    # Без этого файла набор в папке неполный — если её больше никто не держит, убираем целиком
+    job_dir = os.path.dirname(file_path)
+    STORE.unpin(job_dir, f"admin:{key}")
+    if STORE.is_pinned(job_dir):
+        STORE.refresh(job_dir)
+    else:
+        STORE.discard(job_dir)
+    return existed
+
+
+@bot.callback_query_handler(func=lambda call: call.data and call.data.startswith("delete|"))
+async def delete_video_callback(call: types.CallbackQuery):
+    data = call.data.split("|")
+    if len(data) < 2:
+        return
+
+    key = data[1]
+    if key not in ADMIN_DELETE_REQUESTS:
+        await bot.send_message(call.message.chat.id, "Запрос просрочен или недействителен! ⏰🤡")
+        return
+
+    if remove_admin_file(key):
+        await bot.edit_message_text("Контент стер с сервера! 🗑️💥", call.message.chat.id, call.message.message_id)
     else:
-        bot.edit_message_text("Контент уже пропал, как иллюзия! 🕳️😜", call.message.chat.id, call.message.message_id)
+        await bot.edit_message_text("Контент уже пропал, как иллюзия! 🕳️😜", call.message.chat.id, call.message.message_id)
+
+
+def restore_admin_files():
+    """
+    После перезапуска снова закрепляет в STORE файлы, которые ждут админа, и поднимает ссылки на них.
+    Остальное (пропавшие файлы) из ADMIN_DELETE_REQUESTS убирается.
+    """
+    for key, file_path, expires in ADMIN_DELETE_REQUESTS.items():
+        if not os.path.exists(file_path):
+            ADMIN_DELETE_REQUESTS.pop(key)
+            continue
+        job_dir = os.path.dirname(file_path)
+        STORE.pin(job_dir, f"admin:{key}")
+        STORE.adopt(job_dir)
+        FILE_SERVER.restore(key, file_path, round(expires))
+        logging.info(f"Файл админа {file_path} восстановлен после перезапуска")
+
+
+async def run_webhook():
+    """
+    Режим webhook: поднимает HTTP-приёмник и регистрирует WEBHOOK_URL в Telegram.
+    Без WEBHOOK_SECRET не стартует.
+    """
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("Для webhook нужен IBRATSAVE_WEBHOOK_SECRET")
+    server = WebhookServer(
+        bot,
+        WEBHOOK_HOST,
+        WEBHOOK_PORT,
+        WEBHOOK_PATH,
+        WEBHOOK_SECRET,
+        workers=WEBHOOK_WORKERS,
+        shared_seen=SEEN_UPDATES
+    )
+    await server.start()
+    await bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+async def main():
+    restore_admin_files()
+    STORE.start_janitor()
+    FILE_SERVER.start()
+    METRICS_SERVER.start()
+    progress_task = asyncio.create_task(PROGRESS_EDITS.run())
+    try:
+        if WEBHOOK_URL:
+            await run_webhook()
+        else:
+            await bot.delete_webhook()
+            await bot.polling(non_stop=True)
+    finally:
+        progress_task.cancel()
 
 
 if __name__ == "__main__":
-    DOWNLOAD_REQUESTS = {}
-    ADMIN_DELETE_REQUESTS = {}
     print("Бот запущен!")
-    bot.polling(none_stop=True)
+    asyncio.run(main())
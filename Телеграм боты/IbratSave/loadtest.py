@@ -0,0 +1,539 @@
+"""
+Нагрузочный тест IbratSave без интернета.
+
+Запускает настоящие хендлеры бота (link_handler, process_download_callback и т.д.),
+но вместо YouTube/Instagram — заглушка-экстрактор yt-dlp, который отдаёт локальный
+файл с заданной скоростью, а вместо Telegram — локальный фейковый Bot API.
+
+Пример:
+    python loadtest.py --users 50 --links-per-user 3 --rate 2000000
+
+В конце печатает пропускную способность, p50/p99 времени до первого ответа бота
+и до доставки файла, число ошибок и отказов, пиковый размер папки загрузок и память.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, parse_qsl, urlparse
+
+BOT_TOKEN = "123456:loadtest"
+BENCH_HOST = "bench.invalid"
+CDN_CHUNK_SIZE = 64 * 1024
+DISK_SAMPLE_INTERVAL = 0.5
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест IbratSave с фейковым экстрактором и фейковым Bot API")
+    parser.add_argument('--users', type=int, default=20, help="сколько пользователей одновременно")
+    parser.add_argument('--links-per-user', type=int, default=3, help="сколько ссылок кидает каждый пользователь (по очереди)")
+    parser.add_argument('--videos', type=int, default=10, help="сколько разных видео в пуле ссылок (повторы бьют в кэши)")
+    parser.add_argument('--carousel-share', type=float, default=0.2, help="доля ссылок на карусели Instagram")
+    parser.add_argument('--carousel-size', type=int, default=3, help="элементов в карусели")
+    parser.add_argument('--rate', type=int, default=4 * 1024 * 1024, help="скорость отдачи файла с фейкового CDN, байт/сек на соединение")
+    parser.add_argument('--media', help="файл, который отдаёт CDN (по умолчанию генерируется)")
+    parser.add_argument('--media-size', type=int, default=4 * 1024 * 1024, help="размер сгенерированного файла без ffmpeg, байт")
+    parser.add_argument('--skip-transcode', action='store_true',
+                        help="не сообщать размер форматов, тогда бот качает без перекодирования (включается само, если нет ffmpeg)")
+    parser.add_argument('--think-time', type=float, default=1.0, help="сколько «думает» пользователь перед выбором формата, сек")
+    parser.add_argument('--api-rate', type=float, default=0, help="лимит фейкового Bot API, запросов/сек (0 — без лимита, иначе 429)")
+    parser.add_argument('--user-burst', type=int, help="переопределить USER_BURST планировщика")
+    parser.add_argument('--timeout', type=float, default=300, help="сколько ждать одну ссылку, сек")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keep', action='store_true', help="не удалять временную папку после теста")
+    parser.add_argument('--verbose', action='store_true', help="не глушить вывод бота и yt-dlp")
+    return parser.parse_args()
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def make_media(path, size):
+    """
+    Генерирует тестовое видео через ffmpeg, а без ffmpeg — файл из случайных байт нужного размера.
+    """
+    if shutil.which('ffmpeg'):
+        subprocess.run(
+            ['ffmpeg', '-y', '-v', 'error', '-f', 'lavfi', '-i', 'testsrc=duration=20:size=640x360:rate=25',
+             '-f', 'lavfi', '-i', 'sine=duration=20', '-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-c:a', 'aac',
+             '-shortest', path],
+            check=True
+        )
+    else:
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size))
+
+
+class ThrottledCDN:
+    """
+    Локальный HTTP-сервер, который отдаёт один файл со скоростью rate байт/сек на соединение.
+    """
+
+    def __init__(self, media_path, rate):
+        self.media_path = media_path
+        self.rate = rate
+        self.bytes_served = 0
+        self._lock = threading.Lock()
+        self._httpd = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._httpd.server_port}"
+
+    def start(self):
+        from range_server import parse_range
+        cdn = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                size = os.path.getsize(cdn.media_path)
+                try:
+                    byte_range = parse_range(self.headers.get('Range'), size)
+                except ValueError:
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{size}')
+                    self.end_headers()
+                    return
+                start, end = byte_range if byte_range else (0, size - 1)
+                self.send_response(206 if byte_range else 200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(end - start + 1))
+                if byte_range:
+                    self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+                self.end_headers()
+                with open(cdn.media_path, 'rb') as f:
+                    f.seek(start)
+                    remaining = end - start + 1
+                    try:
+                        while remaining > 0:
+                            chunk = f.read(min(CDN_CHUNK_SIZE, remaining))
+                            if not chunk:
+                                break
+                            self.wfile.write(chunk)
+                            remaining -= len(chunk)
+                            with cdn._lock:
+                                cdn.bytes_served += len(chunk)
+                            time.sleep(len(chunk) / cdn.rate)
+                    except (BrokenPipeError, ConnectionResetError):
+                        pass
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._httpd.daemon_threads = True
+        threading.Thread(target=self._httpd.serve_forever, name="loadtest-cdn", daemon=True).start()
+
+    def stop(self):
+        self._httpd.shutdown()
+
+
+def make_bench_extractor(cdn, media_size, report_size):
+    """
+    Экстрактор yt-dlp для ссылок вида https://bench.invalid/watch/<id> (видео с двумя форматами)
+    и https://bench.invalid/instagram.com/p/<id> (карусель; «instagram.com» в пути, чтобы бот
+    повёл её по ветке Instagram).
+    """
+    from yt_dlp.extractor.common import InfoExtractor
+
+    class BenchIE(InfoExtractor):
+        IE_NAME = 'bench'
+        _VALID_URL = r'https?://bench\.invalid/(?P<kind>watch|instagram\.com/p)/(?P<id>[\w-]+)'
+
+        def _real_extract(self, url):
+            kind, video_id = self._match_valid_url(url).group('kind', 'id')
+            query = parse_qs(urlparse(url).query)
+            if kind == 'watch':
+                return {
+                    'id': video_id,
+                    'title': f"Bench video {video_id}",
+                    'duration': 20,
+                    'formats': [self._format(video_id, height) for height in (360, 720)],
+                }
+            count = int(query.get('n', ['3'])[0])
+            return self.playlist_result(
+                [self._entry(video_id, index) for index in range(1, count + 1)],
+                video_id, f"Bench post {video_id}"
+            )
+
+        def _format(self, video_id, height):
+            return {
+                'format_id': f"{height}p",
+                'url': f"{cdn.url}/{video_id}-{height}.mp4",
+                'ext': 'mp4',
+                'height': height,
+                'width': height * 16 // 9,
+                'vcodec': 'avc1.64001f',
+                'acodec': 'mp4a.40.2',
+                'filesize': media_size if report_size else None,
+            }
+
+        def _entry(self, video_id, index):
+            # Нечётные элементы — видео, чётные — фото
+            ext = 'mp4' if index % 2 else 'jpg'
+            return {
+                'id': f"{video_id}-{index}",
+                'title': f"Bench post {video_id}",
+                'url': f"{cdn.url}/{video_id}-{index}.{ext}",
+                'ext': ext,
+            }
+
+    return BenchIE
+
+
+def install_extractor(extractor):
+    """
+    Оставляет в реестре yt-dlp только фейковый экстрактор (тем же путём yt-dlp подключает плагины),
+    так что ни одна ссылка не уйдёт в интернет.
+    """
+    from yt_dlp.extractor import import_extractors
+    from yt_dlp.globals import extractors
+    import_extractors()
+    extractors.value = {extractor.ie_key() + 'IE': extractor}
+
+
+class Flow:
+    """
+    Одна ссылка одного пользователя: от отправки сообщения до доставки файла.
+    """
+
+    def __init__(self, user_id, chat_id, url):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.url = url
+        self.started = time.monotonic()
+        self.first_reply = None
+        self.delivered = None
+        self.outcome = None
+        self.keyboard = asyncio.Event()
+        self.done = asyncio.Event()
+        self.buttons = []
+        self.message_id = None
+
+    def finish(self, outcome):
+        if self.outcome is None:
+            self.outcome = outcome
+            if outcome == 'delivered':
+                self.delivered = time.monotonic()
+            self.done.set()
+
+
+class FakeBotAPI:
+    """
+    Фейковый Telegram Bot API на aiohttp: отвечает как настоящий и сообщает о событиях в Flow чата.
+    """
+
+    def __init__(self, busy_text, api_rate=0):
+        self.busy_text = busy_text
+        self.api_rate = api_rate
+        self.flows = {}
+        self.calls = {}
+        self.flood_waits = 0
+        self.uploaded_bytes = 0
+        self._message_ids = {}
+        self._file_ids = 0
+        self._tokens = api_rate
+        self._refilled_at = time.monotonic()
+        self._runner = None
+        self.port = None
+
+    async def start(self):
+        from aiohttp import web
+        app = web.Application(client_max_size=1024 ** 3)
+        # telebot шлёт часть запросов GET-ом, остальные POST-ом
+        app.router.add_route('*', '/bot{token}/{method}', self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    def _throttled(self):
+        if not self.api_rate:
+            return False
+        now = time.monotonic()
+        self._tokens = min(self.api_rate, self._tokens + (now - self._refilled_at) * self.api_rate)
+        self._refilled_at = now
+        if self._tokens < 1:
+            return True
+        self._tokens -= 1
+        return False
+
+    def _next_message_id(self, chat_id):
+        self._message_ids[chat_id] = self._message_ids.get(chat_id, 1000) + 1
+        return self._message_ids[chat_id]
+
+    def _file(self, kind):
+        self._file_ids += 1
+        file = {'file_id': f"{kind}-{self._file_ids}", 'file_unique_id': f"u{self._file_ids}", 'width': 640, 'height': 360}
+        if kind == 'video':
+            file['duration'] = 20
+        return file
+
+    def _message(self, chat_id, message_id=None, **fields):
+        message = {
+            'message_id': message_id or self._next_message_id(chat_id),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': 123456, 'is_bot': True, 'first_name': 'IbratSave'},
+        }
+        message.update(fields)
+        return message
+
+    async def handle(self, request):
+        from aiohttp import web
+        method = request.match_info['method']
+        self.calls[method] = self.calls.get(method, 0) + 1
+        params = dict(request.query)
+        if request.method == 'POST':
+            data = await request.post()
+        else:
+            # Для GET aiohttp не разбирает тело формы — делаем это сами
+            data = dict(parse_qsl(await request.text()))
+        for name, value in data.items():
+            if hasattr(value, 'file'):
+                self.uploaded_bytes += len(value.file.read())
+            else:
+                params[name] = value
+
+        if self._throttled():
+            self.flood_waits += 1
+            return web.json_response({
+                'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                'parameters': {'retry_after': 1}
+            }, status=429)
+
+        if method == 'getMe':
+            return web.json_response({'ok': True, 'result': {'id': 123456, 'is_bot': True, 'first_name': 'IbratSave', 'username': 'ibratsave_bench_bot'}})
+        if method == 'answerCallbackQuery':
+            return web.json_response({'ok': True, 'result': True})
+
+        chat_id = int(params.get('chat_id', 0))
+        flow = self.flows.get(chat_id)
+        if flow is not None and flow.first_reply is None:
+            flow.first_reply = time.monotonic()
+
+        text = params.get('text', '')
+        if method == 'sendMessage':
+            result = self._message(chat_id, text=text)
+        elif method == 'editMessageText':
+            result = self._message(chat_id, int(params['message_id']), text=text)
+            if 'reply_markup' in params:
+                result['reply_markup'] = json.loads(params['reply_markup'])
+        elif method == 'sendVideo':
+            result = self._message(chat_id, video=self._file('video'))
+        elif method == 'sendPhoto':
+            result = self._message(chat_id, photo=[self._file('photo')])
+        elif method == 'sendMediaGroup':
+            result = [
+                self._message(chat_id, **({'video': self._file('video')} if item['type'] == 'video' else {'photo': [self._file('photo')]}))
+                for item in json.loads(params['media'])
+            ]
+        else:
+            result = True
+
+        if flow is not None:
+            self._observe(flow, method, text, result)
+        return web.json_response({'ok': True, 'result': result})
+
+    def _observe(self, flow, method, text, result):
+        if method in ('sendVideo', 'sendPhoto', 'sendMediaGroup'):
+            flow.finish('delivered')
+            return
+        if method == 'editMessageText' and isinstance(result, dict):
+            buttons = [
+                button['callback_data']
+                for row in result.get('reply_markup', {}).get('inline_keyboard', [])
+                for button in row
+                if button.get('callback_data', '').startswith('download|')
+            ]
+            if buttons:
+                flow.message_id = result['message_id']
+                flow.buttons = buttons
+                flow.keyboard.set()
+                return
+        if text == self.busy_text or 'полегче' in text:
+            flow.finish('rejected')
+        elif 'ошибк' in text.lower() or 'просрочен' in text or 'не удалось' in text.lower() or 'слишком' in text:
+            flow.finish('failed')
+
+
+class LoadTest:
+    def __init__(self, args, server, api):
+        self.args = args
+        self.server = server
+        self.api = api
+        self.flows = []
+        self.random = random.Random(args.seed)
+        self._update_id = 0
+        self._tasks = set()
+
+    def _feed(self, update):
+        from telebot import types
+        self._update_id += 1
+        update['update_id'] = self._update_id
+        task = asyncio.create_task(self.server.bot.process_new_updates([types.Update.de_json(update)]))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def pick_url(self):
+        video_id = f"v{self.random.randrange(self.args.videos)}"
+        if self.random.random() < self.args.carousel_share:
+            return f"https://{BENCH_HOST}/instagram.com/p/{video_id}?n={self.args.carousel_size}"
+        return f"https://{BENCH_HOST}/watch/{video_id}"
+
+    async def run_user(self, index):
+        user_id = 100000 + index
+        user = {'id': user_id, 'is_bot': False, 'first_name': f"user{index}"}
+        for _ in range(self.args.links_per_user):
+            flow = Flow(user_id, user_id, self.pick_url())
+            self.flows.append(flow)
+            self.api.flows[flow.chat_id] = flow
+            self._feed({'message': {
+                'message_id': index, 'date': int(time.time()), 'chat': {'id': flow.chat_id, 'type': 'private'},
+                'from': user, 'text': flow.url
+            }})
+            try:
+                await asyncio.wait_for(self._drive(flow, user), self.args.timeout)
+            except asyncio.TimeoutError:
+                flow.finish('timeout')
+
+    async def _drive(self, flow, user):
+        waiters = [asyncio.ensure_future(flow.keyboard.wait()), asyncio.ensure_future(flow.done.wait())]
+        await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        for waiter in waiters:
+            waiter.cancel()
+        if not flow.done.is_set():
+            await asyncio.sleep(self.args.think_time)
+            self._feed({'callback_query': {
+                'id': str(self._update_id), 'from': user, 'chat_instance': str(flow.chat_id),
+                'data': self.random.choice(flow.buttons),
+                'message': self.api._message(flow.chat_id, flow.message_id, text="Выбери формат")
+            }})
+        await flow.done.wait()
+
+    async def sample_disk(self, peak, stop):
+        from download_store import dir_size
+        while not stop.is_set():
+            size = await asyncio.to_thread(dir_size, self.server.DOWNLOAD_DIR)
+            peak[0] = max(peak[0], size)
+            try:
+                await asyncio.wait_for(stop.wait(), DISK_SAMPLE_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run(self):
+        peak_disk = [0]
+        stop = asyncio.Event()
+        sampler = asyncio.create_task(self.sample_disk(peak_disk, stop))
+        started = time.monotonic()
+        await asyncio.gather(*(self.run_user(i) for i in range(self.args.users)))
+        elapsed = time.monotonic() - started
+        stop.set()
+        await sampler
+        return elapsed, peak_disk[0]
+
+    def report(self, elapsed, peak_disk, cdn):
+        outcomes = {}
+        for flow in self.flows:
+            outcomes[flow.outcome] = outcomes.get(flow.outcome, 0) + 1
+        ttfb = [flow.first_reply - flow.started for flow in self.flows if flow.first_reply]
+        ttd = [flow.delivered - flow.started for flow in self.flows if flow.delivered]
+        delivered = outcomes.get('delivered', 0)
+
+        def fmt(value):
+            return "—" if value is None else f"{value:.3f} сек"
+
+        print()
+        print(f"Пользователей: {self.args.users}, ссылок: {len(self.flows)}, время: {elapsed:.1f} сек")
+        print(f"Пропускная способность: {delivered / elapsed:.2f} доставок/сек")
+        print(f"Исходы: {', '.join(f'{k}={v}' for k, v in sorted(outcomes.items(), key=lambda kv: str(kv[0])))}")
+        print(f"Первый ответ бота: p50 {fmt(percentile(ttfb, 50))}, p99 {fmt(percentile(ttfb, 99))}")
+        print(f"Доставка файла:    p50 {fmt(percentile(ttd, 50))}, p99 {fmt(percentile(ttd, 99))}")
+        print(f"Скачано с CDN: {cdn.bytes_served / 1024 / 1024:.1f} MB, загружено в Bot API: {self.api.uploaded_bytes / 1024 / 1024:.1f} MB")
+        print(f"Вызовы Bot API: {', '.join(f'{k}={v}' for k, v in sorted(self.api.calls.items()))}; 429: {self.api.flood_waits}")
+        print(f"Пик папки загрузок: {peak_disk / 1024 / 1024:.1f} MB")
+        # На Linux ru_maxrss в килобайтах, на macOS — в байтах
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print(f"Пик памяти (RSS): {maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024):.1f} MB")
+
+
+async def run_loadtest(args, server, cdn):
+    import telebot.asyncio_helper
+    api = FakeBotAPI(server.BUSY_TEXT, api_rate=args.api_rate)
+    await api.start()
+    telebot.asyncio_helper.API_URL = f"http://127.0.0.1:{api.port}/bot{{0}}/{{1}}"
+
+    # Как main(), только без polling и файлового сервера
+    server.STORE.start_janitor()
+    progress_task = asyncio.create_task(server.PROGRESS_EDITS.run())
+    test = LoadTest(args, server, api)
+    try:
+        elapsed, peak_disk = await test.run()
+    finally:
+        progress_task.cancel()
+        server.STORE.stop_janitor()
+        session = telebot.asyncio_helper.session_manager.session
+        if session is not None:
+            await session.close()
+        await api.stop()
+    return test, elapsed, peak_disk
+
+
+def main():
+    args = parse_args()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    work_dir = tempfile.mkdtemp(prefix="ibratsave-loadtest-")
+    os.environ['IBRATSAVE_BASE_DIR'] = os.path.join(work_dir, 'bot')
+    os.environ['IBRATSAVE_BOT_TOKEN'] = BOT_TOKEN
+
+    media = args.media
+    if not media:
+        media = os.path.join(work_dir, 'media.mp4')
+        make_media(media, args.media_size)
+    skip_transcode = args.skip_transcode or not shutil.which('ffmpeg')
+    if skip_transcode and not args.skip_transcode:
+        print("ffmpeg не найден — тест без перекодирования (--skip-transcode)")
+
+    cdn = ThrottledCDN(media, args.rate)
+    cdn.start()
+    install_extractor(make_bench_extractor(cdn, os.path.getsize(media), report_size=not skip_transcode))
+
+    import ibratsave_server as server
+    if args.user_burst is not None:
+        server.SCHEDULER.burst = args.user_burst
+
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, 'w'))
+    try:
+        with output:
+            test, elapsed, peak_disk = asyncio.run(run_loadtest(args, server, cdn))
+        test.report(elapsed, peak_disk, cdn)
+    finally:
+        cdn.stop()
+        if args.keep:
+            print(f"Файлы теста: {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
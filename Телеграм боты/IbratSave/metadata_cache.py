@@ -0,0 +1,86 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse
+
+# Параметры ссылок, которые не влияют на само видео
+TRACKING_PARAMS = {'si', 'feature', 'igsh', 'igshid', 'utm_source', 'utm_medium', 'utm_campaign', 'utm_term', 'utm_content', 'fbclid'}
+
+# Ключи, которые yt-dlp добавляет при выборе формата; их убираем перед повторным выбором
+SELECTION_KEYS = ('requested_formats', 'requested_downloads', 'requested_subtitles', 'filepath', '_filename', 'filename')
+
+
+def normalize_url(url: str) -> str:
+    """
+    Приводит ссылку к единому виду: без мусорных параметров, якоря и www,
+    youtu.be и shorts превращаются в обычный watch?v=.
+    """
+    parsed = urlparse(url.strip())
+    host = parsed.netloc.lower()
+    if host.startswith('www.') or host.startswith('m.'):
+        host = host.split('.', 1)[1]
+    path = parsed.path.rstrip('/')
+    query = [(k, v) for k, v in parse_qsl(parsed.query) if k not in TRACKING_PARAMS]
+
+    if host == 'youtu.be' and path:
+        query = [('v', path.lstrip('/'))] + [(k, v) for k, v in query if k != 'v']
+        host, path = 'youtube.com', '/watch'
+    elif host == 'youtube.com' and path.startswith('/shorts/'):
+        query = [('v', path[len('/shorts/'):])] + [(k, v) for k, v in query if k != 'v']
+        path = '/watch'
+
+    return urlunparse(('https', host, path, '', urlencode(sorted(query)), ''))
+
+
+class MetadataCache:
+    """
+    Кэш info-словарей yt-dlp с ограничением по времени жизни и количеству записей.
+    """
+
+    def __init__(self, ttl=1800, max_entries=256):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        key = normalize_url(url)
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            expires_at, info = item
+            if expires_at < time.monotonic():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return info
+
+    def put(self, url, info):
+        key = normalize_url(url)
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, info)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def get_or_extract(self, url, extract):
+        """
+        Возвращает info из кэша, а при промахе вызывает extract() и кладёт результат в кэш.
+        """
+        info = self.get(url)
+        if info is None:
+            info = extract()
+            self.put(url, info)
+        return info
+
+
+def info_for_download(info):
+    """
+    Копия закэшированного info, пригодная для повторного выбора формата в yt-dlp.
+    """
+    info = copy.deepcopy(info)
+    for key in SELECTION_KEYS:
+        info.pop(key, None)
+    return info
@@ -0,0 +1,239 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Границы гистограмм по умолчанию, секунды: от быстрых ответов кэша до долгих скачиваний
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+class Metric:
+    """
+    Базовый класс метрики с метками. Значения хранятся по кортежу значений меток.
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        if not self.labelnames and self.kind != 'histogram':
+            # Метрика без меток видна в /metrics сразу, с нулём
+            self._values[()] = 0
+        self._lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: ожидались метки {self.labelnames}, получены {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """
+        Возвращает список (суффикс имени, метки, значение) для экспорта.
+        """
+        with self._lock:
+            return [('', tuple(zip(self.labelnames, key)), value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if amount < 0:
+            raise ValueError(f"{self.name}: счётчик не может уменьшаться")
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    Текущее значение. Вместо set() можно задать set_function(): тогда значение
+    читается в момент запроса /metrics (удобно для длины очередей).
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self._function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function):
+        self._function = function
+
+    def samples(self):
+        if self._function is not None:
+            try:
+                return [('', (), self._function())]
+            except Exception as e:
+                logging.error(f"Ошибка при чтении метрики {self.name}: {e}")
+                return []
+        return super().samples()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0}
+            state['counts'][bisect.bisect_left(self.buckets, value)] += 1
+            state['sum'] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Замеряет время блока with и записывает его в гистограмму (даже если блок упал).
+        """
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def samples(self):
+        result = []
+        with self._lock:
+            items = [(key, list(state['counts']), state['sum']) for key, state in self._values.items()]
+        for key, counts, total in items:
+            labels = tuple(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                result.append(('_bucket', labels + (('le', _format_value(float(bound))),), cumulative))
+            result.append(('_sum', labels, total))
+            result.append(('_count', labels, cumulative))
+        return result
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self):
+        """
+        Все метрики в текстовом формате Prometheus.
+        """
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class MetricsServer:
+    """
+    HTTP-сервер для Prometheus: отдаёт метрики по /metrics. Вешать лучше на localhost.
+    """
+
+    def __init__(self, host, port, registry=REGISTRY):
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self._httpd = None
+
+    def start(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._httpd.daemon_threads = True
+        threading.Thread(target=self._httpd.serve_forever, name="ibratsave-metrics", daemon=True).start()
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+
+
+# Метрики IbratSave. Стадии: extract — экстракция yt-dlp, queue — ожидание в очереди,
+# download — само скачивание, upload — отправка в Telegram
+STAGE_SECONDS = Histogram(
+    'ibratsave_stage_duration_seconds', "Время стадий обработки ссылки", ['stage']
+)
+FFMPEG_SECONDS = Histogram(
+    'ibratsave_ffmpeg_duration_seconds', "Время работы ffmpeg по варианту обработки", ['plan']
+)
+DOWNLOADED_BYTES = Counter('ibratsave_downloaded_bytes_total', "Скачано байт из источников")
+UPLOADED_BYTES = Counter('ibratsave_uploaded_bytes_total', "Загружено байт в Telegram")
+CACHE_LOOKUPS = Counter(
+    'ibratsave_cache_lookups_total', "Обращения к кэшам (metadata, file_id, store)", ['cache', 'result']
+)
+ERRORS = Counter('ibratsave_errors_total', "Ошибки по экстрактору и стадии", ['extractor', 'stage'])
+PREFETCHES = Counter(
+    'ibratsave_prefetch_total', "Догадки о формате: started, hit, miss, abandoned", ['result']
+)
+PREFETCH_WASTED_BYTES = Counter('ibratsave_prefetch_wasted_bytes_total', "Скачано впустую по неугаданным форматам")
+QUEUED_JOBS = Gauge('ibratsave_queued_jobs', "Задач ждёт в очереди планировщика")
+RUNNING_JOBS = Gauge('ibratsave_running_jobs', "Задач скачивается прямо сейчас")
+TRANSCODE_QUEUED = Gauge('ibratsave_transcode_queued', "Задач ждёт свободного слота перекодирования")
+EXTRACTIONS_IN_FLIGHT = Gauge('ibratsave_extractions_in_flight', "Экстракций выполняется или ждёт пула")
@@ -0,0 +1,80 @@
+import threading
+import time
+from collections import deque
+
+
+class ChoicePredictor:
+    """
+    Запоминает, какие разрешения выбирают пользователи, и угадывает вероятный выбор.
+    Счётчики хранятся в RequestStore (переживают перезапуск); без истории — default.
+    """
+
+    def __init__(self, store, default=720):
+        self.store = store
+        self.default = default
+        self._lock = threading.Lock()
+        self._counts = {int(key): count for key, count, _ in store.items()}
+
+    def record(self, resolution):
+        with self._lock:
+            count = self._counts.get(resolution, 0) + 1
+            self._counts[resolution] = count
+        self.store.put(str(resolution), count)
+
+    def predict(self, resolutions):
+        """
+        Самое популярное разрешение из доступных; при равенстве или без истории — default, если он есть.
+        """
+        resolutions = list(resolutions)
+        if not resolutions:
+            return None
+        with self._lock:
+            counts = dict(self._counts)
+        best = max(resolutions, key=lambda res: (counts.get(res, 0), res == self.default))
+        if counts.get(best, 0) == 0 and self.default not in resolutions:
+            return None
+        return best
+
+
+class WasteBudget:
+    """
+    Сколько байт впустую скачанных догадок можно потратить за скользящее окно window секунд.
+    """
+
+    def __init__(self, budget_bytes, window=3600):
+        self.budget_bytes = budget_bytes
+        self.window = window
+        self._spent = deque()
+        self._lock = threading.Lock()
+
+    def _trim(self, now):
+        while self._spent and self._spent[0][0] < now - self.window:
+            self._spent.popleft()
+
+    def spend(self, amount):
+        if amount <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._trim(now)
+            self._spent.append((now, amount))
+
+    def spent(self):
+        with self._lock:
+            self._trim(time.monotonic())
+            return sum(amount for _, amount in self._spent)
+
+    def allows(self):
+        return self.spent() < self.budget_bytes
+
+
+class Prefetch:
+    """
+    Догадка для одного сообщения с клавиатурой: задача скачивания вероятного формата.
+    """
+
+    def __init__(self, job, task, format_id, cache_key):
+        self.job = job
+        self.task = task
+        self.format_id = format_id
+        self.cache_key = cache_key
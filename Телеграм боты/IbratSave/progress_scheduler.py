@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import time
+
+
+def get_retry_after(error):
+    """
+    Достаёт retry_after из ошибки Telegram API (429 Too Many Requests), иначе None.
+    """
+    result_json = getattr(error, 'result_json', None) or {}
+    parameters = result_json.get('parameters') or {}
+    return parameters.get('retry_after')
+
+
+class ProgressEditScheduler:
+    """
+    Один планировщик правок сообщений о прогрессе для всех активных задач.
+
+    Задачи регистрируются через track() с функцией render(), которая возвращает
+    (text, reply_markup) или (None, None). Планировщик сам опрашивает их и
+    отправляет только последнее состояние, укладываясь в общий лимит
+    (global_rate правок в секунду) и в лимит на чат (не чаще per_chat_interval).
+    При ответе 429 ставит паузу на retry_after и вдвое снижает общий лимит,
+    потом постепенно возвращает его обратно.
+    """
+
+    def __init__(self, edit, global_rate=20.0, per_chat_interval=3.0, tick=0.5, min_rate=1.0, recovery=0.5):
+        self._edit = edit
+        self.global_rate = global_rate
+        self.per_chat_interval = per_chat_interval
+        self.tick = tick
+        self.min_rate = min_rate
+        self.recovery = recovery
+        self._rate = global_rate
+        self._tokens = global_rate
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._entries = {}
+        self._chat_next = {}
+
+    def track(self, chat_id, message_id, render):
+        self._entries[(chat_id, message_id)] = {'render': render, 'last_text': None, 'sent_at': 0.0}
+
+    def untrack(self, chat_id, message_id):
+        self._entries.pop((chat_id, message_id), None)
+
+    @property
+    def current_rate(self):
+        return self._rate
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Ошибка планировщика прогресса: {e}")
+
+    async def flush(self):
+        """
+        Один проход: выбирает, какие сообщения можно обновить сейчас, и отправляет правки.
+        """
+        now = time.monotonic()
+        self._tokens = min(self._rate, self._tokens + (now - self._refilled_at) * self._rate)
+        self._refilled_at = now
+        if now < self._paused_until:
+            return
+
+        batch = []
+        # Сначала те, кого дольше всех не обновляли
+        for key, entry in sorted(self._entries.items(), key=lambda item: item[1]['sent_at']):
+            if self._tokens < 1:
+                break
+            chat_id = key[0]
+            if self._chat_next.get(chat_id, 0) > now:
+                continue
+            text, reply_markup = entry['render']()
+            if text is None or text == entry['last_text']:
+                continue
+            self._tokens -= 1
+            self._chat_next[chat_id] = now + self.per_chat_interval
+            entry['last_text'] = text
+            entry['sent_at'] = now
+            batch.append((key, text, reply_markup))
+
+        if batch:
+            await asyncio.gather(*(self._send(key, text, reply_markup) for key, text, reply_markup in batch))
+
+        self._rate = min(self.global_rate, self._rate + self.recovery * self.tick)
+        for chat_id in [c for c, t in self._chat_next.items() if t <= now]:
+            del self._chat_next[chat_id]
+
+    async def _send(self, key, text, reply_markup):
+        chat_id, message_id = key
+        if key not in self._entries:
+            return
+        try:
+            await self._edit(text, chat_id, message_id, reply_markup=reply_markup)
+        except Exception as e:
+            retry_after = get_retry_after(e)
+            if retry_after:
+                logging.warning(f"Telegram просит подождать {retry_after} сек, снижаем частоту правок")
+                resume_at = time.monotonic() + retry_after
+                self._paused_until = max(self._paused_until, resume_at)
+                self._chat_next[chat_id] = max(self._chat_next.get(chat_id, 0), resume_at)
+                self._rate = max(self.min_rate, self._rate / 2)
+                self._tokens = 0
+                entry = self._entries.get(key)
+                if entry is not None:
+                    entry['last_text'] = None
+            elif "message is not modified" not in str(e):
+                logging.error(f"Ошибка редактирования сообщения: {e}")
@@ -0,0 +1,194 @@
+import hashlib
+import hmac
+import logging
+import os
+import re
+import secrets
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, unquote
+
+CHUNK_SIZE = 256 * 1024
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def parse_range(header, size):
+    """
+    Разбирает заголовок Range (один диапазон). Возвращает (start, end) включительно,
+    None, если заголовка нет, и ValueError, если диапазон невыполним.
+    """
+    if not header:
+        return None
+    match = RANGE_RE.match(header.strip())
+    if not match or size == 0:
+        raise ValueError(header)
+    start, end = match.groups()
+    if start == '':
+        # bytes=-N — последние N байт
+        if end == '' or int(end) == 0:
+            raise ValueError(header)
+        return max(0, size - int(end)), size - 1
+    start = int(start)
+    end = size - 1 if end == '' else min(int(end), size - 1)
+    if start > end:
+        raise ValueError(header)
+    return start, end
+
+
+class FileLinkServer:
+    """
+    Встроенный HTTP-сервер для раздачи больших файлов админам.
+
+    Ссылка вида /f/<key>.<expires>.<подпись>/<имя файла> подписана HMAC и живёт ttl секунд.
+    Поддерживаются HEAD и Range-запросы (докачка, перемотка в плеере).
+    Когда срок ссылки выходит, вызывается on_expire(key, path), чтобы файл убрали с диска.
+    """
+
+    def __init__(self, host, port, public_url, secret=None, ttl=6 * 3600, on_expire=None, reap_interval=60):
+        self.host = host
+        self.port = port
+        self.public_url = public_url.rstrip('/')
+        self.secret = (secret or secrets.token_hex(32)).encode()
+        self.ttl = ttl
+        self.on_expire = on_expire
+        self.reap_interval = reap_interval
+        self._links = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._httpd = None
+
+    def _sign(self, key, expires):
+        message = f"{key}.{expires}".encode()
+        return hmac.new(self.secret, message, hashlib.sha256).hexdigest()[:32]
+
+    def create_link(self, key, path):
+        """
+        Регистрирует файл и возвращает (url, expires) — подписанную ссылку и время её истечения (unix).
+        """
+        return self.restore(key, path, int(time.time() + self.ttl))
+
+    def restore(self, key, path, expires):
+        """
+        Регистрирует файл с заданным сроком — например, после перезапуска бота.
+        Старые ссылки снова работают, только если secret задан явно (а не случайный).
+        """
+        expires = int(expires)
+        with self._lock:
+            self._links[key] = (path, expires)
+        token = f"{key}.{expires}.{self._sign(key, expires)}"
+        return f"{self.public_url}/f/{token}/{quote(os.path.basename(path))}", expires
+
+    def revoke(self, key):
+        with self._lock:
+            self._links.pop(key, None)
+
+    def resolve(self, token):
+        """
+        Проверяет подпись и срок ссылки. Возвращает путь к файлу или None.
+        """
+        try:
+            key, expires, signature = token.split('.')
+            expires = int(expires)
+        except ValueError:
+            return None
+        if not hmac.compare_digest(signature, self._sign(key, expires)) or expires < time.time():
+            return None
+        with self._lock:
+            link = self._links.get(key)
+        if link is None or link[1] != expires or not os.path.isfile(link[0]):
+            return None
+        return link[0]
+
+    def reap(self):
+        """
+        Убирает просроченные ссылки и сообщает о них через on_expire.
+        """
+        now = time.time()
+        with self._lock:
+            expired = [(key, path) for key, (path, expires) in self._links.items() if expires < now]
+            for key, _ in expired:
+                del self._links[key]
+        for key, path in expired:
+            logging.info(f"Ссылка на {path} истекла")
+            if self.on_expire is not None:
+                try:
+                    self.on_expire(key, path)
+                except Exception as e:
+                    logging.error(f"Ошибка при удалении просроченного файла {path}: {e}")
+
+    def start(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_HEAD(self):
+                self.serve(send_body=False)
+
+            def do_GET(self):
+                self.serve(send_body=True)
+
+            def serve(self, send_body):
+                parts = self.path.split('/')
+                if len(parts) < 3 or parts[1] != 'f':
+                    self.send_error(404)
+                    return
+                path = server.resolve(unquote(parts[2]))
+                if path is None:
+                    self.send_error(404, "Link is invalid or expired")
+                    return
+
+                size = os.path.getsize(path)
+                try:
+                    byte_range = parse_range(self.headers.get('Range'), size)
+                except ValueError:
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{size}')
+                    self.end_headers()
+                    return
+
+                start, end = byte_range if byte_range else (0, size - 1)
+                length = end - start + 1 if size else 0
+                self.send_response(206 if byte_range else 200)
+                self.send_header('Accept-Ranges', 'bytes')
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(length))
+                self.send_header(
+                    'Content-Disposition',
+                    f"attachment; filename*=UTF-8''{quote(os.path.basename(path))}"
+                )
+                if byte_range:
+                    self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+                self.end_headers()
+                if not send_body:
+                    return
+
+                with open(path, 'rb') as f:
+                    f.seek(start)
+                    remaining = length
+                    try:
+                        while remaining > 0:
+                            chunk = f.read(min(CHUNK_SIZE, remaining))
+                            if not chunk:
+                                break
+                            self.wfile.write(chunk)
+                            remaining -= len(chunk)
+                    except (BrokenPipeError, ConnectionResetError):
+                        # Клиент оборвал закачку — докачает позже через Range
+                        pass
+
+            def log_message(self, format, *args):
+                logging.info(f"Файловый сервер: {self.address_string()} {format % args}")
+
+        self._httpd = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._httpd.daemon_threads = True
+        threading.Thread(target=self._httpd.serve_forever, name="ibratsave-files", daemon=True).start()
+        threading.Thread(target=self._reaper, name="ibratsave-files-reaper", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        if self._httpd is not None:
+            self._httpd.shutdown()
+
+    def _reaper(self):
+        while not self._stop.wait(self.reap_interval):
+            self.reap()
@@ -0,0 +1,137 @@
+import json
+import sqlite3
+import threading
+import time
+
+
+class RequestStore:
+    """
+    Постоянное хранилище «ключ → значение» для кнопок бота в SQLite.
+
+    Записи живут ttl секунд, в одном пространстве имён хранится не больше max_entries
+    (лишние — самые старые — удаляются). Значения хранятся в JSON, кортежи возвращаются
+    списками. Несколько хранилищ могут жить в одном файле под разными namespace.
+    """
+
+    def __init__(self, db_path, namespace, ttl, max_entries=10000):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS requests (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    expires_at REAL NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                )
+                """
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS requests_expires ON requests (namespace, expires_at)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS requests_created ON requests (namespace, created_at)")
+        self.purge()
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT COUNT(*) FROM requests WHERE namespace = ? AND expires_at >= ?",
+                (self.namespace, time.time())
+            ).fetchone()
+        return row[0]
+
+    def put(self, key, value, ttl=None):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO requests VALUES (?, ?, ?, ?, ?)",
+                (self.namespace, key, json.dumps(value), now, now + (ttl or self.ttl))
+            )
+            self._purge(now)
+
+    def add(self, key, value, ttl=None):
+        """
+        Кладёт запись, только если живой записи с таким ключом ещё нет. Возвращает True, если положили.
+        Атомарно и между процессами, которые работают с одним файлом базы.
+        Как и put, чистит просроченное и лишнее сверх max_entries.
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM requests WHERE namespace = ? AND key = ? AND expires_at < ?",
+                (self.namespace, key, now)
+            )
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO requests VALUES (?, ?, ?, ?, ?)",
+                (self.namespace, key, json.dumps(value), now, now + (ttl or self.ttl))
+            )
+            added = cursor.rowcount == 1
+            self._purge(now)
+            return added
+
+    def get(self, key):
+        """
+        Возвращает значение или None, если записи нет или она просрочена.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM requests WHERE namespace = ? AND key = ? AND expires_at >= ?",
+                (self.namespace, key, time.time())
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def pop(self, key):
+        """
+        Забирает значение и удаляет запись. None, если записи нет или она просрочена.
+        """
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM requests WHERE namespace = ? AND key = ?",
+                (self.namespace, key)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("DELETE FROM requests WHERE namespace = ? AND key = ?", (self.namespace, key))
+        value, expires_at = row
+        return json.loads(value) if expires_at >= time.time() else None
+
+    def items(self):
+        """
+        Живые записи: список (key, value, expires_at).
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, value, expires_at FROM requests WHERE namespace = ? AND expires_at >= ? ORDER BY created_at",
+                (self.namespace, time.time())
+            ).fetchall()
+        return [(key, json.loads(value), expires_at) for key, value, expires_at in rows]
+
+    def purge(self):
+        with self._lock, self._conn:
+            self._purge(time.time())
+
+    def _purge(self, now):
+        # Просроченные и всё, что сверх max_entries (самые старые)
+        self._conn.execute(
+            "DELETE FROM requests WHERE namespace = ? AND expires_at < ?",
+            (self.namespace, now)
+        )
+        self._conn.execute(
+            """
+            DELETE FROM requests WHERE namespace = ? AND key IN (
+                SELECT key FROM requests WHERE namespace = ?
+                ORDER BY created_at DESC LIMIT -1 OFFSET ?
+            )
+            """,
+            (self.namespace, self.namespace, self.max_entries)
+        )
@@ -0,0 +1,56 @@
+import asyncio
+
+
+class Flight:
+    """
+    Одна идущая задача для ключа: ведущий заполняет job, остальные ждут done.
+    """
+
+    def __init__(self):
+        self.job = None
+        self.waiters = 0
+        self.done = asyncio.Event()
+
+    async def wait(self):
+        self.waiters += 1
+        try:
+            await self.done.wait()
+        finally:
+            self.waiters -= 1
+
+
+class SingleFlight:
+    """
+    Склеивает одинаковые одновременные скачивания (ключ — (видео, формат, postprocess)).
+    Первый запросивший становится ведущим и качает, остальные ждут его и потом
+    берут готовый file_id или файл из хранилища. Работает в одном event loop.
+    """
+
+    def __init__(self):
+        self._flights = {}
+
+    def join(self, key):
+        """
+        Возвращает (flight, leader): leader=True — задачи ещё не было, ведёшь ты
+        и обязан вызвать land(key), когда результат будет в кэшах.
+        """
+        flight = self._flights.get(key)
+        if flight is not None:
+            return flight, False
+        flight = Flight()
+        self._flights[key] = flight
+        return flight, True
+
+    def get(self, key):
+        return self._flights.get(key)
+
+    def land(self, key):
+        flight = self._flights.pop(key, None)
+        if flight is not None:
+            flight.done.set()
+
+    def __contains__(self, key):
+        return key in self._flights
+
+    def __len__(self):
+        return len(self._flights)
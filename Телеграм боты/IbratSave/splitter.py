@@ -0,0 +1,79 @@
+import glob
+import logging
+import os
+import subprocess
+
+from metrics import FFMPEG_SECONDS
+from transcode import probe
+
+# Сколько раз пробуем уменьшить длину части, если какая-то всё равно вышла больше лимита
+SPLIT_ATTEMPTS = 4
+# Запас на неравномерный битрейт: первая попытка целится в эту долю лимита
+SPLIT_SAFETY = 0.9
+
+
+def _part_base(path, output_dir=None):
+    base, _ = os.path.splitext(path)
+    if output_dir is not None:
+        base = os.path.join(output_dir, os.path.basename(base))
+    return base
+
+
+def _part_pattern(base):
+    return base + '.part%03d.mp4'
+
+
+def _parts(base):
+    return sorted(glob.glob(glob.escape(base) + '.part[0-9][0-9][0-9].mp4'))
+
+
+def _remove_parts(base):
+    for part in _parts(base):
+        os.remove(part)
+
+
+def split_video(path, max_bytes, job_id='', output_dir=None, max_parts=None):
+    """
+    Режет видео на части меньше max_bytes без перекодирования (stream copy).
+    Резать при копировании можно только по ключевым кадрам, поэтому части получаются
+    чуть разной длины; если какая-то вышла больше лимита, режем мельче.
+    Возвращает пути частей по порядку. Без output_dir части кладутся рядом, а исходный
+    файл удаляется; с output_dir части пишутся туда, а исходный файл остаётся.
+    Если не получилось или частей вышло больше max_parts — RuntimeError.
+    """
+    base = _part_base(path, output_dir)
+    info = probe(path)
+    duration = float(info.get('format', {}).get('duration') or 0)
+    size = os.path.getsize(path)
+    if not duration:
+        raise RuntimeError(f"Не удалось узнать длительность {path}")
+
+    if max_parts and size > max_bytes * SPLIT_SAFETY * max_parts:
+        raise RuntimeError(f"{path} не влезет в {max_parts} частей по {max_bytes} байт")
+
+    segment_time = duration * max_bytes * SPLIT_SAFETY / size
+    for attempt in range(1, SPLIT_ATTEMPTS + 1):
+        _remove_parts(base)
+        with FFMPEG_SECONDS.time(plan='split'):
+            subprocess.run(
+                ['ffmpeg', '-y', '-v', 'error', '-i', path, '-map', '0:v:0', '-map', '0:a:0?', '-c', 'copy',
+                 '-f', 'segment', '-segment_time', f"{segment_time:.3f}", '-reset_timestamps', '1',
+                 '-segment_format', 'mp4', '-segment_format_options', 'movflags=+faststart',
+                 _part_pattern(base)],
+                check=True
+            )
+        parts = _parts(base)
+        biggest = max((os.path.getsize(part) for part in parts), default=0)
+        if max_parts and len(parts) > max_parts:
+            _remove_parts(base)
+            raise RuntimeError(f"{path} разрезался на {len(parts)} частей, больше {max_parts}")
+        if parts and biggest < max_bytes:
+            logging.info(f"[{job_id}] {os.path.basename(path)}: {len(parts)} частей по ~{segment_time:.0f} сек (попытка {attempt})")
+            if output_dir is None:
+                os.remove(path)
+            return parts
+        # Самая большая часть показывает реальный разброс битрейта — уменьшаем пропорционально
+        segment_time *= max_bytes * SPLIT_SAFETY / max(biggest, 1)
+
+    _remove_parts(base)
+    raise RuntimeError(f"Не удалось разрезать {path} на части меньше {max_bytes} байт")
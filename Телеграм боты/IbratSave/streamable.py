@@ -0,0 +1,138 @@
+import logging
+import os
+import struct
+import subprocess
+import uuid
+
+from metrics import FFMPEG_SECONDS
+from transcode import probe
+
+# Ограничения Telegram для превью: JPEG, не больше 320 px по большей стороне
+THUMBNAIL_SIZE = 320
+
+
+def moov_before_mdat(path):
+    """
+    Смотрит верхние атомы mp4: True — moov (индекс) идёт до mdat (данных) и видео
+    можно играть до полной загрузки, False — наоборот, None — не mp4 или не понять.
+    """
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    return None
+                size, kind = struct.unpack('>I4s', header)
+                header_size = 8
+                if size == 1:
+                    size = struct.unpack('>Q', f.read(8))[0]
+                    header_size = 16
+                if kind == b'moov':
+                    return True
+                if kind == b'mdat':
+                    return False
+                if size < header_size:
+                    return None
+                f.seek(size - header_size, os.SEEK_CUR)
+    except OSError:
+        return None
+
+
+def ensure_faststart(path, job_id=''):
+    """
+    Переносит moov в начало файла (remux без перекодирования), если он в конце.
+    Возвращает True, если файл теперь можно стримить.
+    """
+    layout = moov_before_mdat(path)
+    if layout is not False:
+        return bool(layout)
+    base, _ = os.path.splitext(path)
+    output = base + '.faststart.mp4'
+    with FFMPEG_SECONDS.time(plan='faststart'):
+        subprocess.run(
+            ['ffmpeg', '-y', '-v', 'error', '-i', path, '-map', '0', '-c', 'copy', '-movflags', '+faststart', output],
+            check=True
+        )
+    os.replace(output, path)
+    logging.info(f"[{job_id}] {os.path.basename(path)}: moov перенесён в начало")
+    return True
+
+
+def video_meta(probe_info):
+    """
+    duration, width и height для send_video по выводу ffprobe (с учётом поворота).
+    """
+    meta = {}
+    duration = probe_info.get('format', {}).get('duration')
+    if duration:
+        meta['duration'] = int(round(float(duration)))
+    video = next((s for s in probe_info.get('streams', []) if s.get('codec_type') == 'video'), None)
+    if video and video.get('width') and video.get('height'):
+        width, height = video['width'], video['height']
+        rotation = int(video.get('tags', {}).get('rotate', 0) or 0)
+        for side_data in video.get('side_data_list', []):
+            rotation = int(side_data.get('rotation', rotation) or 0)
+        if abs(rotation) % 180 == 90:
+            width, height = height, width
+        meta['width'] = width
+        meta['height'] = height
+    return meta
+
+
+def make_thumbnail(path, thumb_dir, duration=None):
+    """
+    Делает JPEG-превью из кадра на 10% длительности. Возвращает путь к нему.
+    """
+    os.makedirs(thumb_dir, exist_ok=True)
+    output = os.path.join(thumb_dir, f"{uuid.uuid4().hex}.jpg")
+    position = (duration or 0) * 0.1
+    scale = (
+        f"scale='if(gt(iw,ih),{THUMBNAIL_SIZE},-2)':'if(gt(iw,ih),-2,{THUMBNAIL_SIZE})'"
+    )
+    with FFMPEG_SECONDS.time(plan='thumbnail'):
+        subprocess.run(
+            ['ffmpeg', '-y', '-v', 'error', '-ss', f"{position:.2f}", '-i', path,
+             '-frames:v', '1', '-vf', scale, '-q:v', '5', output],
+            check=True
+        )
+    return output
+
+
+def audio_meta(path, title=None):
+    """
+    title, performer и duration для send_audio: из тегов файла (ffprobe), title — запасной заголовок.
+    Если ffprobe нет или он упал, возвращает только title.
+    """
+    meta = {'title': title} if title else {}
+    try:
+        info = probe(path).get('format', {})
+    except Exception as e:
+        logging.error(f"Не удалось прочитать теги {os.path.basename(path)}: {e}")
+        return meta
+    tags = {key.lower(): value for key, value in (info.get('tags') or {}).items()}
+    if tags.get('title'):
+        meta['title'] = tags['title']
+    if tags.get('artist'):
+        meta['performer'] = tags['artist']
+    if info.get('duration'):
+        meta['duration'] = int(round(float(info['duration'])))
+    return meta
+
+
+def prepare_upload(path, thumb_dir, job_id=''):
+    """
+    Готовит видео к отправке так, чтобы оно сразу играло в чате:
+    faststart, duration/width/height из ffprobe, supports_streaming и превью.
+    Возвращает (опции для send_video / InputMediaVideo, путь к превью или None).
+    Если ffmpeg/ffprobe нет или они упали, возвращает то, что успели узнать.
+    """
+    options = {}
+    thumbnail = None
+    try:
+        options['supports_streaming'] = ensure_faststart(path, job_id)
+        info = probe(path)
+        options.update(video_meta(info))
+        thumbnail = make_thumbnail(path, thumb_dir, options.get('duration'))
+    except Exception as e:
+        logging.error(f"[{job_id}] Не удалось подготовить {os.path.basename(path)} к стримингу: {e}")
+    return options, thumbnail
@@ -0,0 +1,46 @@
+import os
+import tempfile
+import time
+import unittest
+
+from request_store import RequestStore
+
+
+class RequestStoreAddTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp.name, 'requests.db')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def rows(self, store):
+        return store._conn.execute(
+            "SELECT COUNT(*) FROM requests WHERE namespace = ?", (store.namespace,)
+        ).fetchone()[0]
+
+    def test_add_respects_max_entries(self):
+        store = RequestStore(self.db_path, 'seen_update', ttl=3600, max_entries=100)
+        for update_id in range(1000):
+            self.assertTrue(store.add(str(update_id), True))
+        self.assertEqual(self.rows(store), 100)
+        self.assertEqual(len(store), 100)
+        # Остались самые свежие
+        self.assertIn('999', store)
+
+    def test_add_purges_expired(self):
+        store = RequestStore(self.db_path, 'seen_update', ttl=0.01)
+        for update_id in range(50):
+            store.add(str(update_id), True)
+        time.sleep(0.05)
+        store.add('last', True)
+        self.assertEqual(self.rows(store), 1)
+
+    def test_add_is_idempotent_for_live_key(self):
+        store = RequestStore(self.db_path, 'seen_update', ttl=3600)
+        self.assertTrue(store.add('1', True))
+        self.assertFalse(store.add('1', True))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,276 @@
+import json
+import logging
+import os
+import subprocess
+import threading
+import time
+
+from yt_dlp.utils import DownloadCancelled
+
+from metrics import FFMPEG_SECONDS
+
+# Что Telegram гарантированно играет прямо в чате
+INLINE_VIDEO_CODECS = {'h264'}
+INLINE_AUDIO_CODECS = {'aac'}
+INLINE_PIX_FMTS = {'yuv420p', 'yuvj420p'}
+INLINE_CONTAINERS = {'mov,mp4,m4a,3gp,3g2,mj2'}
+
+# Что может прийти от yt-dlp и что мы умеем привести к mp4
+TRANSCODE_SOURCE_EXTENSIONS = ('.mp4', '.mov', '.mkv', '.webm')
+
+# Варианты обработки от самого дешёвого к самому дорогому
+PLAN_NONE = 'none'      # файл уже подходит
+PLAN_REMUX = 'remux'    # только перепаковать в mp4
+PLAN_AUDIO = 'audio'    # видео копируем, звук перекодируем в AAC
+PLAN_FULL = 'full'      # полное перекодирование в H.264 + AAC
+
+FULL_ENCODE_ARGS = ['-c:v', 'libx264', '-preset', 'fast', '-crf', '23', '-pix_fmt', 'yuv420p', '-c:a', 'aac']
+
+# Аудиокодек → контейнер, в который его можно переложить без перекодирования
+AUDIO_CONTAINERS = {'aac': '.m4a', 'alac': '.m4a', 'opus': '.opus', 'vorbis': '.ogg', 'mp3': '.mp3'}
+
+# Ужатие под лимит размера: битрейт звука (кбит/с), запас на контейнер и разброс VBV,
+# минимальный осмысленный битрейт видео и сколько раз переделываем, если всё же не влезло
+FIT_AUDIO_BITRATE = 96
+FIT_SAFETY = 0.95
+FIT_MIN_VIDEO_BITRATE = 150
+FIT_ATTEMPTS = 3
+# С какого битрейта видео (кбит/с) какая высота ещё смотрится прилично
+FIT_HEIGHTS = [(2500, 1080), (1200, 720), (700, 480), (350, 360), (0, 240)]
+
+
+def probe(path):
+    """
+    Возвращает вывод ffprobe (streams + format) в виде словаря.
+    """
+    result = subprocess.run(
+        ['ffprobe', '-v', 'error', '-show_streams', '-show_format', '-of', 'json', path],
+        capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout)
+
+
+def plan_transcode(probe_info, path):
+    """
+    Выбирает самый дешёвый способ получить файл, который играет прямо в Telegram.
+    """
+    streams = probe_info.get('streams', [])
+    video = next((s for s in streams if s.get('codec_type') == 'video'), None)
+    audio = next((s for s in streams if s.get('codec_type') == 'audio'), None)
+    container = probe_info.get('format', {}).get('format_name', '')
+
+    video_ok = video is not None and video.get('codec_name') in INLINE_VIDEO_CODECS \
+        and video.get('pix_fmt') in INLINE_PIX_FMTS
+    audio_ok = audio is None or audio.get('codec_name') in INLINE_AUDIO_CODECS
+
+    if not video_ok:
+        return PLAN_FULL
+    if not audio_ok:
+        return PLAN_AUDIO
+    if container in INLINE_CONTAINERS and path.lower().endswith('.mp4'):
+        return PLAN_NONE
+    return PLAN_REMUX
+
+
+def ffmpeg_args(plan, threads=None):
+    if plan == PLAN_REMUX:
+        return ['-c', 'copy']
+    thread_args = ['-threads', str(threads)] if threads else []
+    if plan == PLAN_AUDIO:
+        return ['-c:v', 'copy', '-c:a', 'aac'] + thread_args
+    return list(FULL_ENCODE_ARGS) + thread_args
+
+
+class EncodeSpeed:
+    """
+    Скользящая оценка скорости полного перекодирования: секунд работы на секунду видео.
+    Нужна, чтобы считать, сколько времени сэкономил более дешёвый вариант.
+    """
+
+    def __init__(self, initial=0.5, alpha=0.2):
+        self.seconds_per_second = initial
+        self.alpha = alpha
+        self._lock = threading.Lock()
+
+    def observe(self, elapsed, duration):
+        if not duration:
+            return
+        with self._lock:
+            sample = elapsed / duration
+            self.seconds_per_second = (1 - self.alpha) * self.seconds_per_second + self.alpha * sample
+
+    def estimate(self, duration):
+        with self._lock:
+            return self.seconds_per_second * (duration or 0)
+
+
+ENCODE_SPEED = EncodeSpeed()
+
+
+def run_ffmpeg(args, output, cancel_event=None, poll_interval=0.5):
+    """
+    Запускает ffmpeg и ждёт его, проверяя cancel_event: при отмене процесс убивается,
+    недописанный output удаляется и бросается DownloadCancelled.
+    Ошибка ffmpeg — CalledProcessError, как у subprocess.run(check=True).
+    """
+    process = subprocess.Popen(args)
+    while True:
+        try:
+            returncode = process.wait(timeout=poll_interval)
+            break
+        except subprocess.TimeoutExpired:
+            if cancel_event is not None and cancel_event.is_set():
+                process.kill()
+                process.wait()
+                if os.path.exists(output):
+                    os.remove(output)
+                raise DownloadCancelled("Перекодирование отменено")
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, args)
+
+
+def smart_transcode(path, job_id='', threads=None, cancel_event=None):
+    """
+    Приводит файл к H.264 + AAC в mp4 самым дешёвым способом.
+    threads — сколько потоков дать ffmpeg (None — сколько он возьмёт сам),
+    cancel_event — при его установке ffmpeg прерывается (DownloadCancelled).
+    Возвращает путь к итоговому файлу (исходный удаляется, если был заменён).
+    """
+    started = time.monotonic()
+    info = probe(path)
+    plan = plan_transcode(info, path)
+    duration = float(info.get('format', {}).get('duration') or 0)
+
+    if plan == PLAN_NONE:
+        logging.info(f"[{job_id}] {os.path.basename(path)}: перекодирование не нужно, сэкономлено ~{ENCODE_SPEED.estimate(duration):.1f} сек")
+        return path
+
+    base, _ = os.path.splitext(path)
+    output = base + '.tmp.mp4'
+    with FFMPEG_SECONDS.time(plan=plan):
+        run_ffmpeg(
+            ['ffmpeg', '-y', '-v', 'error', '-i', path, '-map', '0:v:0', '-map', '0:a:0?']
+            + ffmpeg_args(plan, threads)
+            + ['-movflags', '+faststart', output],
+            output,
+            cancel_event
+        )
+    elapsed = time.monotonic() - started
+
+    if plan == PLAN_FULL:
+        ENCODE_SPEED.observe(elapsed, duration)
+        logging.info(f"[{job_id}] {os.path.basename(path)}: полное перекодирование за {elapsed:.1f} сек")
+    else:
+        saved = max(0.0, ENCODE_SPEED.estimate(duration) - elapsed)
+        logging.info(f"[{job_id}] {os.path.basename(path)}: {plan} за {elapsed:.1f} сек, сэкономлено ~{saved:.1f} сек")
+
+    os.remove(path)
+    final_path = base + '.mp4'
+    os.replace(output, final_path)
+    return final_path
+
+
+def remux_audio(path, job_id=''):
+    """
+    Перекладывает звуковую дорожку в m4a/opus/ogg/mp3 без перекодирования (stream copy).
+    Незнакомый кодек перекодируется в AAC. Возвращает путь к итоговому файлу (исходный удаляется).
+    """
+    info = probe(path)
+    audio = next((s for s in info.get('streams', []) if s.get('codec_type') == 'audio'), None)
+    if audio is None:
+        raise RuntimeError(f"В {os.path.basename(path)} нет звуковой дорожки")
+    extension = AUDIO_CONTAINERS.get(audio.get('codec_name'))
+    base, current = os.path.splitext(path)
+    if extension == current.lower() and len(info.get('streams', [])) == 1:
+        return path
+
+    codec_args = ['-c:a', 'copy'] if extension else ['-c:a', 'aac']
+    extension = extension or '.m4a'
+    output = base + '.tmp' + extension
+    plan = 'audio_copy' if codec_args[1] == 'copy' else 'audio_encode'
+    with FFMPEG_SECONDS.time(plan=plan):
+        subprocess.run(
+            ['ffmpeg', '-y', '-v', 'error', '-i', path, '-map', '0:a:0', '-vn'] + codec_args
+            + (['-movflags', '+faststart'] if extension == '.m4a' else [])
+            + [output],
+            check=True
+        )
+    logging.info(f"[{job_id}] {os.path.basename(path)}: звук → {extension} ({plan})")
+    os.remove(path)
+    final_path = base + extension
+    os.replace(output, final_path)
+    return final_path
+
+
+def plan_fit(duration, max_bytes, source_height=None):
+    """
+    Считает, как уложить видео длиной duration секунд в max_bytes: битрейты видео и звука
+    (кбит/с), высоту кадра и предсказанный размер в байтах (верхняя граница).
+    None, если даже минимальный битрейт не влезает.
+    """
+    if not duration:
+        return None
+    total_kbps = max_bytes * FIT_SAFETY * 8 / 1000 / duration
+    video_kbps = int(total_kbps - FIT_AUDIO_BITRATE)
+    if video_kbps < FIT_MIN_VIDEO_BITRATE:
+        return None
+    height = next(h for min_kbps, h in FIT_HEIGHTS if video_kbps >= min_kbps)
+    if source_height:
+        height = min(height, source_height)
+    return {
+        'video_kbps': video_kbps,
+        'audio_kbps': FIT_AUDIO_BITRATE,
+        'height': height,
+        'size': int((video_kbps + FIT_AUDIO_BITRATE) * 1000 / 8 * duration),
+    }
+
+
+def fit_to_size(path, max_bytes, job_id='', threads=None, cancel_event=None):
+    """
+    Перекодирует видео в H.264 + AAC mp4 так, чтобы файл был меньше max_bytes:
+    CRF с потолком битрейта (-maxrate/-bufsize) по plan_fit и уменьшение кадра, если битрейта мало.
+    Если файл всё же вышел больше, повторяет с битрейтом, уменьшенным пропорционально.
+    cancel_event — как у smart_transcode.
+    Возвращает путь к итоговому файлу (исходный удаляется). Если не получилось — RuntimeError.
+    """
+    info = probe(path)
+    duration = float(info.get('format', {}).get('duration') or 0)
+    video = next((s for s in info.get('streams', []) if s.get('codec_type') == 'video'), None)
+    plan = plan_fit(duration, max_bytes, video.get('height') if video else None)
+    if plan is None:
+        raise RuntimeError(f"{os.path.basename(path)} не ужать до {max_bytes} байт: слишком длинный")
+
+    base, _ = os.path.splitext(path)
+    output = base + '.fit.mp4'
+    video_kbps = plan['video_kbps']
+    thread_args = ['-threads', str(threads)] if threads else []
+    for attempt in range(1, FIT_ATTEMPTS + 1):
+        started = time.monotonic()
+        with FFMPEG_SECONDS.time(plan='fit'):
+            run_ffmpeg(
+                ['ffmpeg', '-y', '-v', 'error', '-i', path, '-map', '0:v:0', '-map', '0:a:0?',
+                 '-vf', f"scale=-2:'min({plan['height']},ih)'",
+                 '-c:v', 'libx264', '-preset', 'fast', '-crf', '23', '-pix_fmt', 'yuv420p',
+                 '-maxrate', f"{video_kbps}k", '-bufsize', f"{video_kbps * 2}k",
+                 '-c:a', 'aac', '-b:a', f"{plan['audio_kbps']}k"]
+                + thread_args
+                + ['-movflags', '+faststart', output],
+                output,
+                cancel_event
+            )
+        size = os.path.getsize(output)
+        logging.info(
+            f"[{job_id}] {os.path.basename(path)}: ужато до {size} байт "
+            f"({plan['height']}p, {video_kbps} кбит/с) за {time.monotonic() - started:.1f} сек, попытка {attempt}"
+        )
+        if size < max_bytes:
+            os.remove(path)
+            final_path = base + '.mp4'
+            os.replace(output, final_path)
+            return final_path
+        video_kbps = int(video_kbps * max_bytes * FIT_SAFETY / size)
+        if video_kbps < FIT_MIN_VIDEO_BITRATE:
+            break
+
+    os.remove(output)
+    raise RuntimeError(f"Не удалось ужать {os.path.basename(path)} до {max_bytes} байт")
@@ -0,0 +1,100 @@
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from yt_dlp.utils import DownloadCancelled
+
+from metrics import STAGE_SECONDS
+
+
+def available_cores():
+    """
+    Сколько ядер реально доступно процессу (с учётом taskset/cgroup cpuset).
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+class TranscodePool:
+    """
+    Второй этап конвейера: перекодирование отдельно от скачиваний.
+
+    - Скачивания упираются в сеть и живут в DownloadEngine, перекодирование упирается
+      в процессор и идёт здесь, так что одно не занимает слоты другого.
+    - Одновременно работает workers процессов ffmpeg, каждому даётся threads потоков,
+      чтобы вместе они занимали доступные ядра, но не дрались за них.
+    - Очередь FIFO; position показывает место задачи для сообщения о статусе.
+    """
+
+    def __init__(self, workers=None, threads_per_job=2, cores=None):
+        cores = cores or available_cores()
+        self.workers = workers or max(1, cores // threads_per_job)
+        self.threads = max(1, cores // self.workers)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="ibratsave-ffmpeg")
+        self._waiting = []
+        self._running = set()
+        self._lock = threading.Lock()
+
+    def submit(self, job, fn, *args):
+        """
+        Запускает fn(*args, threads=...) в пуле. Если задачу отменили, пока она ждала, fn не вызывается.
+        """
+        queued_at = time.monotonic()
+        with self._lock:
+            self._waiting.append(job)
+
+        def run():
+            with self._lock:
+                self._waiting.remove(job)
+                self._running.add(job)
+            STAGE_SECONDS.observe(time.monotonic() - queued_at, stage='transcode_queue')
+            try:
+                if job.cancelled:
+                    raise DownloadCancelled(f"Задача {job.job_id} отменена")
+                with STAGE_SECONDS.time(stage='transcode'):
+                    return fn(*args, threads=self.threads)
+            finally:
+                with self._lock:
+                    self._running.discard(job)
+        return self.executor.submit(run)
+
+    def chain(self, job, download_future, fn):
+        """
+        Когда скачивание (download_future) успешно завершится, ставит fn(job) в этот пул.
+        Возвращает Future всего конвейера.
+        """
+        result = Future()
+
+        def relay(future):
+            if future.exception() is not None:
+                result.set_exception(future.exception())
+            else:
+                result.set_result(future.result())
+
+        def on_downloaded(future):
+            if future.exception() is not None:
+                relay(future)
+                return
+            self.submit(job, fn, job).add_done_callback(relay)
+
+        download_future.add_done_callback(on_downloaded)
+        return result
+
+    def position(self, job):
+        """
+        Сколько задач ждёт перекодирования раньше этой (0 — следующая). None, если задача не ждёт.
+        """
+        with self._lock:
+            if job in self._waiting:
+                return self._waiting.index(job)
+        return None
+
+    def is_running(self, job):
+        with self._lock:
+            return job in self._running
+
+    def waiting_count(self):
+        with self._lock:
+            return len(self._waiting)
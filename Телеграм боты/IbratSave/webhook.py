@@ -0,0 +1,97 @@
+import asyncio
+import hmac
+import logging
+from collections import OrderedDict
+
+from aiohttp import web
+from telebot import types
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookServer:
+    """
+    Приём обновлений Telegram через webhook вместо polling.
+
+    - Проверяет секрет из заголовка X-Telegram-Bot-Api-Secret-Token; без секрета не запускается,
+      иначе обновления мог бы подсунуть любой, кто достучится до порта.
+    - Отвечает Telegram сразу, а обработку отдаёт очереди и пулу из workers корутин
+      (это же ограничивает число одновременно работающих хендлеров).
+    - Отбрасывает повторы update_id: Telegram присылает обновление ещё раз, если не
+      дождался ответа. Локально помнит последние dedup_size id, а если задан shared_seen
+      (RequestStore с методом add), то и между процессами за одним reverse proxy.
+    - Если очередь заполнена, отвечает 503 — Telegram повторит позже.
+    """
+
+    def __init__(self, bot, host, port, path, secret_token, workers=64, queue_size=1000, dedup_size=10000, shared_seen=None):
+        if not secret_token:
+            raise ValueError("Webhook без секрета не запускаем: задайте secret_token")
+        self.bot = bot
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self.workers = workers
+        self.dedup_size = dedup_size
+        self.shared_seen = shared_seen
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._seen = OrderedDict()
+        self._tasks = []
+        self._runner = None
+
+    def _is_duplicate(self, update_id):
+        if update_id in self._seen:
+            return True
+        self._seen[update_id] = True
+        while len(self._seen) > self.dedup_size:
+            self._seen.popitem(last=False)
+        # Другой процесс мог уже взять это обновление
+        return self.shared_seen is not None and not self.shared_seen.add(str(update_id), True)
+
+    async def handle(self, request):
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), self.secret_token):
+            logging.warning(f"Webhook: запрос с неверным секретом от {request.remote}")
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+            update_id = data['update_id']
+        except Exception:
+            return web.Response(status=400)
+
+        if self._is_duplicate(update_id):
+            return web.Response()
+        try:
+            self._queue.put_nowait(data)
+        except asyncio.QueueFull:
+            # Забываем id, чтобы принять повтор от Telegram
+            self._seen.pop(update_id, None)
+            if self.shared_seen is not None:
+                self.shared_seen.pop(str(update_id))
+            logging.warning("Webhook: очередь обновлений заполнена")
+            return web.Response(status=503)
+        return web.Response()
+
+    async def _worker(self):
+        while True:
+            data = await self._queue.get()
+            try:
+                await self.bot.process_new_updates([types.Update.de_json(data)])
+            except Exception as e:
+                logging.error(f"Ошибка обработки обновления {data.get('update_id')}: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logging.info(f"Webhook слушает {self.host}:{self.port}{self.path}")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        if self._runner is not None:
+            await self._runner.cleanup()